@@ -0,0 +1,22 @@
+import argparse
+
+from QUT.settings import traverses, camera_names
+from QUT.util.Traverse import consolidate_descriptors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Consolidate the exported global descriptors of each "
+        "traverse and camera into a single memory-mappable array."
+    )
+    parser.add_argument("experiment_name", type=str)
+    parser.add_argument(
+        "--traverses", type=str, nargs="+", default=list(traverses.keys())
+    )
+    parser.add_argument("--cameras", type=str, nargs="+", default=camera_names)
+    args = parser.parse_args()
+
+    for traverse in args.traverses:
+        for cam_name in args.cameras:
+            path = consolidate_descriptors(args.experiment_name, traverse, cam_name)
+            print("Wrote {}".format(path))
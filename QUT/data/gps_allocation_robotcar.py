@@ -1,59 +1,116 @@
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from scipy.spatial.transform import Rotation
+from scipy.spatial.transform import Rotation, Slerp
 import pandas as pd
 
 from hfnet.settings import DATA_PATH, RAW_PATH
 import thirdparty.robotcar_dataset_sdk as sdk
-from thirdparty.robotcar_dataset_sdk.python.interpolate_poses import (
-    interpolate_ins_poses,
-)
-from thirdparty.robotcar_dataset_sdk.python.transform import (
-    build_se3_transform,
-    se3_to_components,
-)
+from thirdparty.robotcar_dataset_sdk.python.transform import build_se3_transform
 from QUT.settings import traverses, camera_names
 from QUT.util.geometry import SE3
-from QUT.util.Traverse import Camera, Traverse
+
+
+def load_ins(ins_path):
+    """
+    Loads the INS log as arrays of timestamps, translations and rotations.
+    """
+    ins = pd.read_csv(
+        ins_path,
+        usecols=["timestamp", "northing", "easting", "down", "roll", "pitch", "yaw"],
+    )
+    timestamps = ins["timestamp"].to_numpy()
+    xyz = ins[["northing", "easting", "down"]].to_numpy()
+    # R = Rz(yaw) Ry(pitch) Rx(roll), as build_se3_transform
+    R = Rotation.from_euler("ZYX", ins[["yaw", "pitch", "roll"]].to_numpy())
+    return timestamps, xyz, R
+
+
+def interpolate_ins_poses(ins, timestamps):
+    """
+    Vectorized counterpart of the SDK `interpolate_ins_poses`: slerps the
+    rotations and linearly interpolates the translations of the INS log at
+    all requested timestamps at once. Timestamps outside of the log are
+    clamped to its first and last poses.
+    Args:
+        ins : output of `load_ins`
+        timestamps (N,) : UNIX timestamps at which poses are required
+    Returns:
+        SE3 with N absolute poses
+    """
+    ins_tstamps, xyz, R = ins
+    # relative times keep microsecond precision in float64
+    ins_times = (ins_tstamps - ins_tstamps[0]).astype(float)
+    times = np.clip(
+        (np.asarray(timestamps) - ins_tstamps[0]).astype(float), 0, ins_times[-1]
+    )
+    t = np.stack([np.interp(times, ins_times, xyz[:, i]) for i in range(3)], axis=-1)
+    return SE3(t, Slerp(ins_times, R)(times))
+
+
+def to_xyzrpy(poses):
+    """
+    Translations and Euler angles of poses, as the SDK `se3_to_components`.
+    """
+    T = poses.as_mat().reshape(-1, 4, 4)
+    roll = np.arctan2(T[:, 2, 1], T[:, 2, 2])
+    pitch = np.arctan2(-T[:, 2, 0], np.hypot(T[:, 0, 0], T[:, 1, 0]))
+    yaw = np.arctan2(T[:, 1, 0], T[:, 0, 0])
+    return np.concatenate([T[:, :3, 3], np.stack([roll, pitch, yaw], -1)], -1)
+
+
+def load_extrinsics(extrinsics_dir, name):
+    with open(os.path.join(extrinsics_dir, "{}.txt".format(name))) as extrinsics_file:
+        extrinsics = next(extrinsics_file)
+    T = build_se3_transform([float(x) for x in extrinsics.split(" ")])
+    return SE3.from_mat(np.asarray(T))
+
+
+def allocate_traverse(traverse, datetime, extrinsics_dir, save_dir):
+    ins = load_ins(os.path.join(RAW_PATH, datetime, "gps/ins.csv"))
+    T_ext_ste_ins = load_extrinsics(extrinsics_dir, "ins")
+    for cam_name in camera_names:
+        # retrieve list of image tstamps
+        img_folder = os.path.join(DATA_PATH, "robotcar/images", traverse, cam_name)
+        img_paths = os.listdir(img_folder)
+        tstamps = [int(os.path.basename(img_path)[:-4]) for img_path in img_paths]
+        interp_poses = interpolate_ins_poses(ins, tstamps)
+        # apply camera extrinsics to INS for abs camera poses. Note extrinsics are relative
+        # to the STEREO camera, so compose extrinsics for ins and mono to get true cam pose
+        T_ext_ste_mono = load_extrinsics(extrinsics_dir, "mono_{}".format(cam_name))
+        T_ext_ins_mono = T_ext_ste_ins.inv() * T_ext_ste_mono
+        mono_poses = interp_poses * T_ext_ins_mono
+        df = pd.DataFrame(
+            to_xyzrpy(mono_poses),
+            columns=["northing", "easting", "down", "roll", "pitch", "yaw"],
+        )
+        df.insert(0, "timestamp", tstamps, True)
+        trav_save_dir = os.path.join(save_dir, traverse)
+        if not os.path.exists(trav_save_dir):
+            os.makedirs(trav_save_dir)
+        df.to_csv(os.path.join(trav_save_dir, "{}_poses.csv".format(cam_name)))
+    return traverse
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_workers", type=int, default=len(traverses))
+    args = parser.parse_args()
+
     sdk_path = os.path.abspath(sdk.__file__)
     extrinsics_dir = os.path.join(os.path.dirname(sdk_path), "extrinsics")
     save_dir = os.path.join(DATA_PATH, "robotcar/gps")
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
-    for traverse, datetime in traverses.items():
-        for cam_name in camera_names:
-            # retrieve list of image tstamps
-            img_folder = os.path.join(DATA_PATH, "robotcar/images", traverse, cam_name)
-            img_paths = os.listdir(img_folder)
-            tstamps = [int(os.path.basename(img_path)[:-4]) for img_path in img_paths]
-            ins_path = os.path.join(RAW_PATH, datetime, "gps/ins.csv")
-            interp_poses = np.asarray(interpolate_ins_poses(ins_path, tstamps))
-            # apply camera extrinsics to INS for abs camera poses. Note extrinsics are relative
-            # to the STEREO camera, so compose extrinsics for ins and mono to get true cam pose
-            with open(os.path.join(extrinsics_dir, "ins.txt")) as extrinsics_file:
-                extrinsics = next(extrinsics_file)
-            T_ext_ste_ins = np.asarray(
-                build_se3_transform([float(x) for x in extrinsics.split(" ")])
-            )
-            with open(
-                os.path.join(extrinsics_dir, "mono_{}.txt".format(cam_name))
-            ) as extrinsics_file:
-                extrinsics = next(extrinsics_file)
-            T_ext_ste_mono = np.asarray(
-                build_se3_transform([float(x) for x in extrinsics.split(" ")])
-            )
-            T_ext_ins_mono = np.linalg.solve(T_ext_ste_ins, T_ext_ste_mono)
-            mono_poses = interp_poses @ T_ext_ins_mono
-            xyzrpys = [se3_to_components(pose) for pose in mono_poses]
-            df = pd.DataFrame(
-                xyzrpys, columns=["northing", "easting", "down", "roll", "pitch", "yaw"]
+    # the INS log of a traverse is loaded once for all of its cameras
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = [
+            executor.submit(
+                allocate_traverse, traverse, datetime, extrinsics_dir, save_dir
             )
-            df.insert(0, "timestamp", tstamps, True)
-            trav_save_dir = os.path.join(save_dir, traverse)
-            if not os.path.exists(trav_save_dir):
-                os.makedirs(trav_save_dir)
-            df.to_csv(os.path.join(trav_save_dir, "{}_poses.csv".format(cam_name)))
+            for traverse, datetime in traverses.items()
+        ]
+        for future in futures:
+            print("Allocated poses for {}".format(future.result()))
@@ -18,7 +18,8 @@ from hfnet.evaluation.utils.db_management import (
 )
 from hfnet.evaluation.utils.localization import (
     covis_clustering,
-    match_against_place,
+    cached_match_against_place,
+    MatchCache,
     do_pnp,
     preprocess_globaldb,
     preprocess_localdb,
@@ -39,29 +40,77 @@ sys.modules["hfnet.evaluation.db_management"] = db_management  # backward comp
 class LocalizationOpt(Localization):
     def __init__(self, dataset_name, model_name, config, build_db=False):
         super().__init__(dataset_name, model_name, config, build_db=build_db)
+        self.name_to_index = {name: i for i, name in enumerate(self.db_names)}
         # load GPS data for reference
         if dataset_name == "robotcar":
             traverse = "overcast-reference"
         self.gps = Traverse(dataset_name, traverse, config["global"]["experiment"])
+        # precomputed distractors per query traverse and number of distractors
+        self.distractor_sets = {}
 
-    def init_queries(self, query_file, query_config, prefix=""):
+    def init_queries(self, query_file, query_config, prefix="", traverse_name=None):
         queries = read_query_list(Path(self.base_path, query_file), prefix=prefix)
         Dataset = get_dataset(query_config.get("name", self.dataset_name))
         query_config = {**query_config, "image_names": [q.name for q in queries]}
         query_dataset = Dataset(**query_config)
-        # load GPS data for queries
-        query_gps = Traverse(self.dataset_name, self.config["queries"],
-                             self.gps.experiment_name)
+        # load GPS data for queries, only for the cameras of the queries
+        if traverse_name is None:
+            traverse_name = self.config["queries"]
+        query_cameras = sorted(set(q.name.split("/")[1] for q in queries))
+        query_gps = Traverse(self.dataset_name, traverse_name,
+                             self.gps.experiment_name, cameras=query_cameras)
         return queries, query_dataset, query_gps
 
-    def localize(self, query_info, query_data, query_gps, debug=False):
+    def distractors(self, query_gps, query_attr, k):
+        """
+        Same as `self.gps.retrieve_distractors(query_attr, k)`, computed for
+        all images of the query traverse at once.
+        """
+        key = (query_gps.traverse_name, k)
+        if key not in self.distractor_sets:
+            self.distractor_sets[key] = self.gps.distractor_sets(query_gps, k)[1]
+        ind = query_gps.aggregated_index(query_attr["camera"], query_attr["ind"])
+        return self.gps.retrieved_attrs(
+            self.distractor_sets[key][ind], query_attr["pose"])
+
+    def retrieve(self, query_gps, query_attr, num_nearest, num_distractors,
+                 imperfect=False):
+        """
+        Oracle retrieval: the num_nearest reference images closest in pose
+        and num_distractors top ranked images that are not relevant, or the
+        num_distractors top ranked images if num_nearest is 0.
+        """
+        if num_nearest > 0:
+            distractors = self.distractors(query_gps, query_attr, num_distractors)
+            nearest = self.gps.kNN(query_attr["pose"], num_nearest,
+                                   imperfect=imperfect)
+            return nearest + distractors
+        return self.gps.topk_descriptors(query_attr, num_distractors)
+
+    def localize(self, query_info, query_data, query_gps, debug=False,
+                 retrieval=None, query_item=None, match_cache=None):
+        """
+        Args:
+            retrieval: dict overriding the `num_nearest`, `num_distractors`
+                and `imperfect` entries of the config.
+            query_item: query features, extracted from query_data if None.
+            match_cache: MatchCache used instead of self.match_cache.
+        """
         config_global = self.config["global"]
         config_local = self.config["local"]
         config_pose = self.config["pose"]
+        if retrieval is None:
+            retrieval = {
+                "num_nearest": self.config["num_nearest"],
+                "num_distractors": self.config["num_distractors"],
+                "imperfect": self.config.get("imperfect", False),
+            }
         timings = {}
 
         # Fetch data
-        query_item = extract_query(query_data, query_info, config_global, config_local)
+        if query_item is None:
+            query_item = extract_query(
+                query_data, query_info, config_global, config_local)
 
         # C++ backend
         if self.use_cpp:
@@ -77,18 +126,9 @@ class LocalizationOpt(Localization):
                 query_item.global_desc[np.newaxis])[0]
             splits = query_info.name.split("/")
             query_attr = query_gps.query_attr(splits[1], int(splits[2][:-4]))
-            if self.config["num_nearest"] > 0:
-                distractors = self.gps.retrieve_distractors(
-                    query_attr, self.config["num_distractors"])
-                nearest = self.gps.kNN(query_attr["pose"],
-                                       self.config["num_nearest"],
-                                       self.config["imperfect"])
-                relevant_cameras = nearest + distractors
-            else:
-                relevant_cameras = self.gps.topk_descriptors(
-                    query_attr, self.config["num_distractors"])
+            relevant_cameras = self.retrieve(query_gps, query_attr, **retrieval)
             indices = retrieve_indices(self.dataset_name,
-                                       self.db_names, relevant_cameras)
+                                       self.name_to_index, relevant_cameras)
             prior_ids = self.db_ids[indices]
         timings["global"] = t.duration
 
@@ -105,12 +145,13 @@ class LocalizationOpt(Localization):
         for place in clustered_frames:
             # Local matching
             matches_data = {} if debug else None
-            matches, place_lms, duration = match_against_place(
+            matches, place_lms, duration = cached_match_against_place(
+                self.match_cache if match_cache is None else match_cache,
+                query_info.name,
                 place,
                 self.local_db,
                 local_desc,
-                config_local["ratio_thresh"],
-                do_fast_matching=config_local.get("fast_matching", True),
+                config_local,
                 debug_dict=matches_data,
             )
             timings["local"] += duration
@@ -168,6 +209,29 @@ class LocalizationOpt(Localization):
             return result, {"timings": timings}
 
 
+def summarize(results, all_stats):
+    success = np.array([r.success for r in results])
+    num_inliers = np.array([r.num_inliers for r in results])
+    ratios = np.array([r.inlier_ratio for r in results])
+
+    metrics = {
+        "success": np.mean(success),
+        "inliers": np.mean(num_inliers[success]),
+        "inlier_ratios": np.mean(ratios[success]),
+        "failure": np.arange(len(success))[np.logical_not(success)],
+    }
+    metrics = {k: v.tolist() for k, v in metrics.items()}
+    metrics["all_stats"] = all_stats
+    return metrics
+
+
+def save_match_cache(loc):
+    if loc.match_cache is not None:
+        logging.info(f"Match cache: {loc.match_cache.hits} hits, "
+                     f"{loc.match_cache.misses} misses")
+        loc.match_cache.save()
+
+
 def evaluate(loc, queries, query_dataset, query_gps, max_iter=None):
     results = []
     all_stats = []
@@ -182,16 +246,44 @@ def evaluate(loc, queries, query_dataset, query_gps, max_iter=None):
             if len(results) == max_iter:
                 break
 
-    success = np.array([r.success for r in results])
-    num_inliers = np.array([r.num_inliers for r in results])
-    ratios = np.array([r.inlier_ratio for r in results])
+    save_match_cache(loc)
+    return summarize(results, all_stats), results
 
-    metrics = {
-        "success": np.mean(success),
-        "inliers": np.mean(num_inliers[success]),
-        "inlier_ratios": np.mean(ratios[success]),
-        "failure": np.arange(len(success))[np.logical_not(success)],
-    }
-    metrics = {k: v.tolist() for k, v in metrics.items()}
-    metrics["all_stats"] = all_stats
-    return metrics, results
+
+def sweep(loc, queries, query_dataset, query_gps, retrievals, max_iter=None):
+    """
+    Evaluates several retrieval configurations in a single pass over the
+    queries. The query features are extracted once per query and the matches
+    against a place are shared by all configurations retrieving it.
+    Args:
+        retrievals: list of dicts with entries `num_nearest`,
+            `num_distractors` and `imperfect`.
+    Returns:
+        a list of (metrics, results), one per retrieval configuration.
+    """
+    config_global = loc.config["global"]
+    config_local = loc.config["local"]
+    results = [[] for _ in retrievals]
+    all_stats = [[] for _ in retrievals]
+    query_iter = query_dataset.get_test_set()
+    # without a cache configured, matches are shared between the
+    # configurations of the current query only
+    match_cache = loc.match_cache
+    if match_cache is None:
+        match_cache = MatchCache(max_size=1000)
+
+    for i, (query_info, query_data) in enumerate(
+        tqdm(zip(queries, query_iter), total=len(queries))
+    ):
+        if max_iter is not None and i == max_iter:
+            break
+        query_item = extract_query(query_data, query_info, config_global, config_local)
+        for j, retrieval in enumerate(retrievals):
+            result, stats = loc.localize(
+                query_info, query_data, query_gps, retrieval=retrieval,
+                query_item=query_item, match_cache=match_cache)
+            results[j].append(result)
+            all_stats[j].append(stats)
+
+    save_match_cache(loc)
+    return [(summarize(r, s), r) for r, s in zip(results, all_stats)]
@@ -15,12 +15,15 @@ def topk_matching_gps(query_pose, db_gps, k, imperfect=False):
     return cameras, cameras_agg
 
 
-def retrieve_indices(dataset_name, db_names, topk_cameras):
+def retrieve_indices(dataset_name, name_to_index, topk_cameras):
+    """Database indices of the retrieved cameras, name_to_index maps the
+    database image names to their index in `db_names`.
+    """
     if dataset_name == "robotcar":
         reference = "overcast-reference"
     keys = [
         reference + "/" + camera["camera"] + "/" + str(camera["timestamp"]) + ".jpg"
         for camera in topk_cameras
     ]
-    indices = [db_names.index(key) for key in keys]
+    indices = [name_to_index[key] for key in keys]
     return indices
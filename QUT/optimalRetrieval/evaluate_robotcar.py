@@ -1,5 +1,6 @@
 import os
 import logging
+import itertools
 from pathlib import Path
 import argparse
 from pprint import pformat
@@ -7,7 +8,7 @@ import yaml
 import numpy as np
 from pyquaternion import Quaternion
 
-from QUT.evaluation.localizationOpt import LocalizationOpt, evaluate
+from QUT.evaluation.localizationOpt import LocalizationOpt, sweep
 from hfnet.evaluation.loaders import export_loader
 from hfnet.settings import EXPER_PATH
 
@@ -78,6 +79,39 @@ config_robotcar = {
 }
 
 
+def write_results(output_dir, eval_name, config, metrics, queries, results,
+                  export_poses=False):
+    output = {"config": config, "metrics": metrics}
+    if "night" in config["queries"]:
+        query_cat = "night"
+    else:
+        query_cat = "day"
+    suffix = f"{config['num_nearest']}NN_{config['num_distractors']}d"
+    eval_filename = f"{eval_name}_{query_cat}_{suffix}"
+    eval_filename_yaml = f"{eval_name}_{config['queries']}_{suffix}"
+    if config["imperfect"]:
+        eval_filename += "_imperf"
+        eval_filename_yaml += "_imperf"
+    eval_path = Path(output_dir, f"{eval_filename_yaml}.yaml")
+    with open(eval_path, "w") as f:
+        yaml.dump(output, f, default_flow_style=False)
+
+    if export_poses:
+        poses_path = Path(output_dir, f"{eval_filename}_poses.txt")
+        if os.path.exists(poses_path):
+            append_write = "a"
+        else:
+            append_write = "w"
+        with open(poses_path, append_write) as f:
+            for query, result in zip(queries, results):
+                query_T_w = np.linalg.inv(result.T)
+                qvec_nvm = list(Quaternion(matrix=query_T_w))
+                pos_nvm = query_T_w[:3, 3].tolist()
+                name = "/".join(query.name.split("/")[-2:])
+                line = name + " " + " ".join(map(str, qvec_nvm + pos_nvm))
+                f.write(line + "\n")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("model", type=str)
@@ -85,15 +119,26 @@ if __name__ == "__main__":
     parser.add_argument("--local_method", type=str)
     parser.add_argument("--global_method", type=str)
     parser.add_argument("--build_db", action="store_true")
-    parser.add_argument("--queries", type=str, default="dusk_left")
+    parser.add_argument("--queries", type=str, nargs="+", default=["dusk_left"])
     parser.add_argument("--max_iter", type=int)
     parser.add_argument("--export_poses", action="store_true")
     parser.add_argument("--cpp_backend", action="store_true")
-    parser.add_argument("--num_nearest", default=1, type=int)
-    parser.add_argument("--num_distractors", default=1, type=int)
+    parser.add_argument("--match_cache", type=str,
+                        help="file caching the local matches across runs")
+    # several values sweep over all combinations, loading the map once
+    parser.add_argument("--num_nearest", default=[1], type=int, nargs="+")
+    parser.add_argument("--num_distractors", default=[1], type=int, nargs="+")
     parser.add_argument("--imperfect", action="store_true")
+    parser.add_argument("--sweep_imperfect", action="store_true",
+                        help="evaluate both perfect and imperfect retrieval")
     args = parser.parse_args()
 
+    imperfect = [False, True] if args.sweep_imperfect else [args.imperfect]
+    retrievals = [
+        {"num_nearest": k, "num_distractors": d, "imperfect": i}
+        for k, d, i in itertools.product(
+            args.num_nearest, args.num_distractors, imperfect)
+    ]
     config = {
         "global": configs_global[args.global_method],
         "local": configs_local[args.local_method],
@@ -101,55 +146,29 @@ if __name__ == "__main__":
         "pose": config_pose,
         "model": args.model,
         "max_iter": args.max_iter,
-        "queries": args.queries,
+        "queries": args.queries[0],
         "use_cpp": args.cpp_backend,
-        "num_nearest": args.num_nearest,
-        "num_distractors": args.num_distractors,
-        "imperfect": args.imperfect,
+        "match_cache": (None if args.match_cache is None
+                        else {"path": args.match_cache}),
+        **retrievals[0],
     }
     logging.info("Evaluating Robotcar with configuration: \n" + pformat(config))
     loc = LocalizationOpt("robotcar", args.model, config, build_db=args.build_db)
 
-    query_file = f"queries/{args.queries}_queries_with_intrinsics.txt"
-    queries, query_dataset, query_gps = loc.init_queries(query_file, config_robotcar)
-
-    logging.info("Starting evaluation")
-    metrics, results = evaluate(
-        loc, queries, query_dataset, query_gps, max_iter=args.max_iter
-    )
-    logging.info("Evaluation metrics: \n" + pformat(metrics))
-
-    output = {"config": config, "metrics": metrics}
     output_dir = Path(EXPER_PATH, "eval/robotcar")
     output_dir.mkdir(exist_ok=True, parents=True)
-    if "night" in args.queries:
-        query_cat = "night"
-    else:
-        query_cat = "day"
-    eval_filename = (
-        f"{args.eval_name}_{query_cat}_{args.num_nearest}NN_{args.num_distractors}d"
-    )
-    eval_filename_yaml = (
-        f"{args.eval_name}_{args.queries}_{args.num_nearest}NN_{args.num_distractors}d"
-    )
-    if args.imperfect:
-        eval_filename += "_imperf"
-        eval_filename_yaml += "_imperf"
-    eval_path = Path(output_dir, f"{eval_filename_yaml}.yaml")
-    with open(eval_path, "w") as f:
-        yaml.dump(output, f, default_flow_style=False)
+    for queries_name in args.queries:
+        query_file = f"queries/{queries_name}_queries_with_intrinsics.txt"
+        queries, query_dataset, query_gps = loc.init_queries(
+            query_file, config_robotcar, traverse_name=queries_name)
 
-    if args.export_poses:
-        poses_path = Path(output_dir, f"{eval_filename}_poses.txt")
-        if os.path.exists(poses_path):
-            append_write = "a"
-        else:
-            append_write = "w"
-        with open(poses_path, append_write) as f:
-            for query, result in zip(queries, results):
-                query_T_w = np.linalg.inv(result.T)
-                qvec_nvm = list(Quaternion(matrix=query_T_w))
-                pos_nvm = query_T_w[:3, 3].tolist()
-                name = "/".join(query.name.split("/")[-2:])
-                line = name + " " + " ".join(map(str, qvec_nvm + pos_nvm))
-                f.write(line + "\n")
+        logging.info(f"Starting evaluation of {len(retrievals)} "
+                     f"configurations on {queries_name}")
+        outputs = sweep(loc, queries, query_dataset, query_gps, retrievals,
+                        max_iter=args.max_iter)
+        for retrieval, (metrics, results) in zip(retrievals, outputs):
+            run_config = {**config, "queries": queries_name, **retrieval}
+            logging.info(f"Evaluation metrics for {retrieval}: \n"
+                         + pformat(metrics))
+            write_results(output_dir, args.eval_name, run_config, metrics,
+                          queries, results, export_poses=args.export_poses)
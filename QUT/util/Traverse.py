@@ -1,4 +1,5 @@
 import os
+import logging
 from collections import namedtuple
 from bisect import bisect_left
 
@@ -7,55 +8,215 @@ import pandas as pd
 from tqdm import tqdm
 
 from hfnet.settings import DATA_PATH, EXPER_PATH
+from hfnet.utils.export_store import ExportStore
 from . import geometry
 from .geometry import SE3
 
 Camera = namedtuple("Camera", ["poses", "timestamps", "descriptors"])
-attributes = ["name", "timestamps", "traverse_name", "dataset_name", "experiment_name"]
+# all cameras of a traverse stacked camera after camera, built once
+Aggregate = namedtuple(
+    "Aggregate", ["poses", "timestamps", "camera_ids", "descriptors", "index"]
+)
+
+
+def descriptor_dir(experiment_name, traverse_name, cam_name):
+    return os.path.join(EXPER_PATH, "exports", experiment_name, traverse_name, cam_name)
+
+
+def export_store(experiment_name):
+    """
+    Container of the exports of an experiment, or None if they are stored as
+    individual files.
+    """
+    base_dir = os.path.join(EXPER_PATH, "exports", experiment_name)
+    return ExportStore(base_dir) if ExportStore.exists(base_dir) else None
+
+
+def export_mtime(experiment_name, traverse_name, cam_name):
+    """
+    Last modification time of the exports of a camera, or None if they were
+    removed.
+    """
+    base_dir = os.path.join(EXPER_PATH, "exports", experiment_name)
+    if ExportStore.exists(base_dir):
+        return max(os.path.getmtime(p) for p in ExportStore.index_paths(base_dir))
+    export_dir = descriptor_dir(experiment_name, traverse_name, cam_name)
+    if not os.path.isdir(export_dir):
+        return None
+    return os.path.getmtime(export_dir)
+
+
+def export_timestamps(experiment_name, traverse_name, cam_name):
+    """
+    Sorted timestamps of the exported images of a camera.
+    """
+    store = export_store(experiment_name)
+    if store is not None:
+        prefix = "{}/{}/".format(traverse_name, cam_name)
+        with store:
+            names = [n[len(prefix) :] for n in store.names() if n.startswith(prefix)]
+    else:
+        export_dir = descriptor_dir(experiment_name, traverse_name, cam_name)
+        names = [f[:-4] for f in os.listdir(export_dir) if f.endswith(".npz")]
+    return np.sort([int(n) for n in names])
+
+
+def descriptor_cache_paths(experiment_name, traverse_name, cam_name):
+    """
+    Paths of the consolidated global descriptors of a camera and of their
+    timestamp index, stored next to the per-image export directory.
+    """
+    prefix = descriptor_dir(experiment_name, traverse_name, cam_name)
+    return prefix + "_global_descriptors.npy", prefix + "_timestamps.npy"
+
+
+def load_descriptors_per_file(experiment_name, traverse_name, cam_name, timestamps):
+    """
+    Reads the global descriptors from the individual <timestamp>.npz exports,
+    or from the entries of the export container.
+    """
+    store = export_store(experiment_name)
+    if store is not None:
+        prefix = "{}/{}/".format(traverse_name, cam_name)
+        with store:
+            return np.stack(
+                [
+                    store.read(prefix + str(tstamp))["global_descriptor"]
+                    for tstamp in tqdm(timestamps)
+                ]
+            )
+    export_dir = descriptor_dir(experiment_name, traverse_name, cam_name)
+    example_fname = os.listdir(export_dir)[0]
+    example = np.load(os.path.join(export_dir, example_fname))["global_descriptor"]
+    descriptors = np.empty((len(timestamps), len(example)), dtype=example.dtype)
+    for i, tstamp in enumerate(tqdm(timestamps)):
+        dpath = os.path.join(export_dir, str(tstamp) + ".npz")
+        descriptors[i, :] = np.load(dpath)["global_descriptor"]
+    return descriptors
+
+
+def consolidate_descriptors(experiment_name, traverse_name, cam_name):
+    """
+    Writes all exported global descriptors of a camera into a single array
+    file with rows sorted by timestamp, along with the timestamp index.
+    Needs to be rerun when the exports are modified.
+    """
+    timestamps = export_timestamps(experiment_name, traverse_name, cam_name)
+    descriptors = load_descriptors_per_file(
+        experiment_name, traverse_name, cam_name, timestamps
+    )
+    desc_path, tstamp_path = descriptor_cache_paths(
+        experiment_name, traverse_name, cam_name
+    )
+    # packed exports have no per-camera directory
+    os.makedirs(os.path.dirname(desc_path), exist_ok=True)
+    # the index is written first, a newer descriptor file marks a complete cache
+    for path, array in [(tstamp_path, timestamps), (desc_path, descriptors)]:
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(path + ".tmp", path)
+    return desc_path
+
+
+def load_descriptors(experiment_name, traverse_name, cam_name, timestamps):
+    """
+    Global descriptors of a camera in the order of the given timestamps.
+    Memory-maps the consolidated cache when it is up to date or when the
+    individual exports were removed, otherwise falls back to reading them.
+    """
+    desc_path, tstamp_path = descriptor_cache_paths(
+        experiment_name, traverse_name, cam_name
+    )
+    if os.path.exists(desc_path) and os.path.exists(tstamp_path):
+        mtime = export_mtime(experiment_name, traverse_name, cam_name)
+        if mtime is None:
+            # the individual exports were deleted after consolidation
+            logging.info(
+                "No exports for %s, cannot check that the cache is up to date.",
+                desc_path,
+            )
+            mtime = 0
+        fresh = os.path.getmtime(desc_path) >= max(
+            os.path.getmtime(tstamp_path), mtime
+        )
+        cached_tstamps = np.load(tstamp_path)
+        ind = np.searchsorted(cached_tstamps, timestamps)
+        ind[ind == len(cached_tstamps)] = 0
+        if fresh and len(cached_tstamps) and np.all(cached_tstamps[ind] == timestamps):
+            descriptors = np.load(desc_path, mmap_mode="r")
+            if np.array_equal(ind, np.arange(len(descriptors))):
+                return descriptors
+            return descriptors[ind]
+        logging.warning(
+            "Stale descriptor cache %s, reading individual exports.", desc_path
+        )
+    return load_descriptors_per_file(
+        experiment_name, traverse_name, cam_name, timestamps
+    )
 
 
 class Traverse:
-    def __init__(self, dataset_name, traverse_name, experiment_name):
+    def __init__(self, dataset_name, traverse_name, experiment_name, cameras=None):
+        """
+        Cameras are loaded on first access, `cameras` optionally restricts
+        the traverse to a subset of camera names.
+        """
         self.dataset_name = dataset_name
         self.traverse_name = traverse_name
         self.experiment_name = experiment_name
-        # import INS data
+        # locate INS data of each camera
         gps_dir = os.path.join(DATA_PATH, dataset_name, "gps", traverse_name)
-        for i, gpsname in enumerate(os.listdir(gps_dir)):
-            camera_df = pd.read_csv(os.path.join(gps_dir, gpsname))
-            cam_name = gpsname[:-10]
-            camera_df.sort_values(by=["timestamp"], inplace=True)
-            # set traverse timestamps
-            if i == 0:
-                self.timestamps = np.squeeze(camera_df[["timestamp"]].to_numpy())
-            else:
-                curr_tstamps = np.squeeze(camera_df[["timestamp"]].to_numpy())
-                assert np.array_equal(self.timestamps, curr_tstamps), (
-                    "Timestamps between cameras are inconsistent, please"
-                    "check that the cameras come from the same traverse!"
+        gps_files = {
+            gpsname[:-10]: os.path.join(gps_dir, gpsname)
+            for gpsname in os.listdir(gps_dir)
+        }
+        if cameras is not None:
+            missing = set(cameras) - set(gps_files)
+            if missing:
+                raise ValueError(
+                    "No INS data for cameras {} in {}".format(missing, gps_dir)
                 )
-            xyzrpy = camera_df[
-                ["northing", "easting", "down", "roll", "pitch", "yaw"]
-            ].to_numpy()
-            # read descriptors
-            descriptor_dir = os.path.join(
-                EXPER_PATH,
-                "exports",
-                experiment_name,
-                traverse_name,
-                cam_name,
-            )
-            example_fname = os.listdir(descriptor_dir)[0]
-            D = len(np.load(os.path.join(descriptor_dir, example_fname))
-                    ["global_descriptor"])
-            descriptors = np.empty((len(self.timestamps), D))
-            for i, tstamp in enumerate(tqdm(self.timestamps)):
-                dpath = os.path.join(descriptor_dir, str(tstamp) + ".npz")
-                descriptors[i, :] = np.load(dpath)["global_descriptor"]
-            poses = SE3.from_xyzrpy(xyzrpy)
-            camera = Camera(poses=poses, timestamps=self.timestamps,
-                            descriptors=descriptors)
-            setattr(self, cam_name, camera)
+        self.camera_names = [
+            cam_name for cam_name in gps_files if cameras is None or cam_name in cameras
+        ]
+        self._gps_files = gps_files
+        # set traverse timestamps
+        self.timestamps = np.sort(
+            pd.read_csv(
+                gps_files[self.camera_names[0]], usecols=["timestamp"]
+            )["timestamp"].to_numpy()
+        )
+        self._aggregated = None
+
+    def __getattr__(self, name):
+        # only called for missing attributes, i.e. cameras not loaded yet
+        if name in self.__dict__.get("camera_names", []):
+            camera = self._load_camera(name)
+            setattr(self, name, camera)
+            return camera
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(type(self).__name__, name)
+        )
+
+    def _load_camera(self, cam_name):
+        # import INS data
+        camera_df = pd.read_csv(self._gps_files[cam_name])
+        camera_df.sort_values(by=["timestamp"], inplace=True)
+        curr_tstamps = np.squeeze(camera_df[["timestamp"]].to_numpy())
+        assert np.array_equal(self.timestamps, curr_tstamps), (
+            "Timestamps between cameras are inconsistent, please"
+            "check that the cameras come from the same traverse!"
+        )
+        xyzrpy = camera_df[
+            ["northing", "easting", "down", "roll", "pitch", "yaw"]
+        ].to_numpy()
+        # read descriptors
+        descriptors = load_descriptors(
+            self.experiment_name, self.traverse_name, cam_name, self.timestamps
+        )
+        poses = SE3.from_xyzrpy(xyzrpy)
+        return Camera(poses=poses, timestamps=self.timestamps,
+                      descriptors=descriptors)
 
     def __len__(self):
         return len(self.timestamps)
@@ -65,122 +226,174 @@ class Traverse:
         query_desc = query_attr["descriptor"]
         query_pose = query_attr["pose"]
         # top k most similar descriptors
-        poses, timestamps, cameras, descriptors = self._aggregate()
-        dist_sq = 2 - 2 * descriptors @ query_desc
+        agg = self._aggregate()
+        dist_sq = 2 - 2 * agg.descriptors @ query_desc
         match_ind = np.argpartition(dist_sq, k)[:k]
         match_ind = match_ind[np.argsort(dist_sq[match_ind])]
-        # extract INS information
-        t_err, R_err = geometry.error(query_pose, poses)
-        retrieved = []
-        for ind in match_ind:
-            retrieved.append(
-                {
-                    "camera": cameras[ind],
-                    "timestamp": timestamps[ind],
-                    "t_err": t_err[ind],
-                    "R_err": R_err[ind] * 180 / np.pi,
-                    "ind": ind,
-                }
-            )
-        return retrieved
+        # extract INS information of the matches only
+        t_err, R_err = geometry.error(query_pose, agg.poses[match_ind])
+        return self._retrieved(match_ind, t_err, R_err)
 
     def retrieve_distractors(self, query_attr, k):
         # identify relevant images
         query_pose = query_attr["pose"]
         relevant = self.kNN(query_pose, 10)
-        relevant_ind = [attr["ind"] for attr in relevant]
+        relevant_ind = set(attr["ind"] for attr in relevant)
         # image retrieval
         img_retrieval = self.topk_descriptors(query_attr, 10 + k)
-        retrieval_ind = [attr["ind"] for attr in img_retrieval]
-        # compute INS error
-        poses, timestamps, cameras, descriptors = self._aggregate()
-        t_err, R_err = geometry.error(query_pose, poses)
         # cull retrieved images that are close to gt ("relevant")
-        distractors = []
-        for ind in retrieval_ind:
-            if ind not in relevant_ind and len(distractors) < k:
-                distractors.append(
-                    {
-                        "camera": cameras[ind],
-                        "timestamp": timestamps[ind],
-                        "t_err": t_err[ind],
-                        "R_err": R_err[ind] * 180 / np.pi,
-                        "ind": ind,
-                    })
-        return distractors
+        distractors = [
+            attr for attr in img_retrieval if attr["ind"] not in relevant_ind
+        ]
+        return distractors[:k]
+
+    def distractor_sets(self, query, k, num_relevant=10, alpha=5, chunk_size=256):
+        """
+        Batch counterpart of `retrieve_distractors` for all images of the
+        query traverse. The results are cached to disk per query traverse
+        and k.
+        Returns:
+            relevant (Q x num_relevant) : nearest reference images in pose
+            distractors (Q x k) : top ranked reference images by descriptor
+                that are not relevant
+            Both hold aggregated reference indices, rows follow the
+            aggregated query images.
+        """
+        path = os.path.join(
+            EXPER_PATH, "exports", self.experiment_name, self.traverse_name,
+            "distractors_{}_{}.npz".format(query.traverse_name, k),
+        )
+        meta = {
+            "timestamps": self.timestamps,
+            "cameras": np.array(self.camera_names),
+            "query_timestamps": query.timestamps,
+            "query_cameras": np.array(query.camera_names),
+            "params": np.array([num_relevant, alpha]),
+        }
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                if all(np.array_equal(cached[key], v) for key, v in meta.items()):
+                    return cached["relevant"], cached["distractors"]
+
+        agg, query_agg = self._aggregate(), query._aggregate()
+        num_top = num_relevant + k
+        if len(agg.descriptors) < num_top:
+            raise ValueError(
+                "{} reference images, at least num_relevant + k = {} are "
+                "required".format(len(agg.descriptors), num_top)
+            )
+        relevant = np.stack([
+            agg.index.knn(query_agg.poses[i], num_relevant, alpha)[0]
+            for i in range(len(query_agg.poses))
+        ])
+        # top ranked images by descriptor, one chunk of queries at a time
+        top = np.empty((len(relevant), num_top), dtype=int)
+        for start in range(0, len(top), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            dist_sq = 2 - 2 * query_agg.descriptors[chunk] @ agg.descriptors.T
+            ind = np.argpartition(dist_sq, num_top - 1, axis=1)[:, :num_top]
+            order = np.argsort(np.take_along_axis(dist_sq, ind, 1), axis=1)
+            top[chunk] = np.take_along_axis(ind, order, 1)
+        # first k retrieved images that are not relevant, there are always
+        # at least k of them
+        is_relevant = (top[:, :, None] == relevant[:, None, :]).any(-1)
+        first = np.argsort(is_relevant, axis=1, kind="stable")[:, :k]
+        distractors = np.take_along_axis(top, first, 1)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, relevant=relevant, distractors=distractors, **meta)
+        os.replace(path + ".tmp", path)
+        return relevant, distractors
 
     def query_attr(self, camera, timestamp):
         """
         Return pose  and descriptor for camera/timestamp pair within traverse.
         """
+        cam_name = camera
         camera = getattr(self, camera)
         # locate camera timestamp index and return associated pose
         i = bisect_left(camera.timestamps, timestamp)
         if i != len(camera.timestamps) and camera.timestamps[i] == timestamp:
             return {"pose": camera.poses[i],
                     "descriptor": camera.descriptors[i],
+                    "camera": cam_name,
                     "ind": i}
         return None
 
+    def aggregated_index(self, camera, ind):
+        """
+        Index among all cameras of the image ind of the given camera.
+        """
+        return self.camera_names.index(camera) * len(self) + ind
+
+    def retrieved_attrs(self, match_ind, pose):
+        """
+        Attributes of the images at the given aggregated indices, with their
+        errors w.r.t. pose.
+        """
+        t_err, R_err = geometry.error(pose, self._aggregate().poses[match_ind])
+        return self._retrieved(match_ind, t_err, R_err)
+
     def kNN(self, pose, k, alpha=5, imperfect=False):
-        retrieved = []
-        # aggregate all cameras and find NN images
-        poses, timestamps, cameras, _ = self._aggregate()
-        # find NNs
-        t_err, R_err = geometry.error(pose, poses)
-        dist = geometry.metric(pose, poses, alpha)
+        # find NN images among all cameras
+        agg = self._aggregate()
         if imperfect:
             # imperfect retrieval retrieves k random relevant images
-            match_ind = np.argpartition(dist, max(10, k))[:max(10, k)]
-            match_ind = np.random.choice(match_ind, k)
+            match_ind, _ = agg.index.knn(pose, max(10, k), alpha)
+            match_ind = match_ind[np.sort(np.random.choice(len(match_ind), k))]
         else:
-            match_ind = np.argpartition(dist, k)[:k]
-        match_ind = match_ind[np.argsort(dist[match_ind])]
-        for ind in match_ind:
-            retrieved.append(
-                {
-                    "camera": cameras[ind],
-                    "timestamp": timestamps[ind],
-                    "t_err": t_err[ind],
-                    "R_err": R_err[ind] * 180 / np.pi,
-                    "ind": ind,
-                }
-            )
-        return retrieved
+            match_ind, _ = agg.index.knn(pose, k, alpha)
+        t_err, R_err = geometry.error(pose, agg.poses[match_ind])
+        return self._retrieved(match_ind, t_err, R_err)
 
     def query_tolerance(self, pose, t, R):
         """
         Return all images inside given error tolerances to given pose.
         """
-        retrieved = []
-        for cam_name, camera in self.__dict__.items():
-            if cam_name not in attributes:
-                t_err, R_err = geometry.error(pose, camera.poses)
-                match = np.logical_and(t_err < t, R_err * 180 / np.pi < R)
-                match_ind = np.squeeze(np.argwhere(match))
-                for ind in match_ind:
-                    retrieved.append(
-                        {
-                            "camera": cam_name,
-                            "timestamp": self.timestamps[ind],
-                            "t_err": t_err[ind],
-                            "R_err": R_err[ind] * 180 / np.pi,
-                            "ind": ind,
-                        }
-                    )
+        match_ind, t_err, R_err = self._aggregate().index.within(pose, t, R)
+        retrieved = self._retrieved(match_ind, t_err, R_err)
+        # index within the camera rather than among all cameras
+        for attr in retrieved:
+            attr["ind"] = attr["ind"] % len(self)
         return retrieved
 
     def _aggregate(self):
-        poses = []
-        timestamps = []
-        cameras = []
-        descriptors = []
-        for cam_name, camera in self.__dict__.items():
-            if cam_name not in attributes:
-                poses.extend(camera.poses)
-                timestamps.extend(self.timestamps)
-                cameras.extend(len(self.timestamps) * [cam_name])
-                descriptors.append(camera.descriptors)
-        poses = geometry.combine(poses)
-        descriptors = np.concatenate(descriptors, axis=0)
-        return poses, timestamps, cameras, descriptors
+        if self._aggregated is None:
+            self._aggregated = self._build_aggregate()
+        return self._aggregated
+
+    def _build_aggregate(self):
+        cameras = [getattr(self, cam_name) for cam_name in self.camera_names]
+        poses = geometry.combine([camera.poses for camera in cameras])
+        timestamps = np.tile(self.timestamps, len(cameras))
+        camera_ids = np.repeat(np.arange(len(cameras)), len(self.timestamps))
+        descriptors = np.concatenate(
+            [camera.descriptors for camera in cameras], axis=0
+        )
+        # half precision exports are upcast once for all similarity searches
+        if descriptors.dtype == np.float16:
+            descriptors = descriptors.astype(np.float32)
+        descriptors.setflags(write=False)
+        index = geometry.PoseIndex(poses)
+        return Aggregate(poses, timestamps, camera_ids, descriptors, index)
+
+    def _retrieved(self, match_ind, t_err, R_err):
+        """
+        Attributes of retrieved images given their aggregated indices and
+        errors w.r.t. the query.
+        """
+        agg = self._aggregate()
+        t_err, R_err = np.atleast_1d(t_err), np.atleast_1d(R_err)
+        retrieved = []
+        for ind, t, R in zip(match_ind, t_err, R_err):
+            retrieved.append(
+                {
+                    "camera": self.camera_names[agg.camera_ids[ind]],
+                    "timestamp": agg.timestamps[ind],
+                    "t_err": t,
+                    "R_err": R * 180 / np.pi,
+                    "ind": ind,
+                }
+            )
+        return retrieved
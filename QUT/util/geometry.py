@@ -1,17 +1,35 @@
 import numpy as np
 import math
 
+from scipy.spatial import cKDTree
 from scipy.spatial.transform import Rotation
 
 
 class SE3:
+    """
+    Set of N poses stored as stacked arrays of translations (N x 3) and unit
+    quaternions (N x 4, scalar last as in scipy). All operations work on the
+    arrays directly, without per-pose objects.
+    """
+
     def __init__(self, t, R):
+        self._set(t, R.as_quat())
+
+    def _set(self, t, quat):
         self._single = False
+        t = np.asarray(t, dtype=float)
+        quat = np.asarray(quat, dtype=float)
 
         if t.ndim not in [1, 2] or t.shape[-1] != 3:
             raise ValueError(
                 "Expected `t` to have shape (3,) or (N x 3), got {}.".format(t.shape)
             )
+        if quat.ndim not in [1, 2] or quat.shape[-1] != 4:
+            raise ValueError(
+                "Expected quaternions of shape (4,) or (N x 4), got {}.".format(
+                    quat.shape
+                )
+            )
 
         # If a single translation is given, convert it to a
         # 2D 1 x 3 matrix but set self._single to True so that
@@ -19,24 +37,29 @@ class SE3:
         if t.shape == (3,):
             t = t[None, :]
             self._single = True
-            if len(R) > 1:
-                raise ValueError(
-                    "Different number of translations 1 and rotations {}.".format(
-                        len(R)
-                    )
-                )
         elif len(t) == 1:
             self._single = True
-        else:
-            if len(t) != len(R):
-                raise ValueError(
-                    "Differing number of translations {} and rotations {}".format(
-                        len(t), len(R)
-                    )
+        quat = np.reshape(quat, (-1, 4))
+        if len(t) != len(quat):
+            raise ValueError(
+                "Differing number of translations {} and rotations {}".format(
+                    len(t), len(quat)
                 )
+            )
         self._t = t
-        self._R = R
-        self.len = len(R)
+        self._q = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+        self.len = len(t)
+
+    @classmethod
+    def from_arrays(cls, t, quat):
+        """
+        Args:
+            t (N x 3 or 3,) : translations
+            quat (N x 4 or 4,) : quaternions (x, y, z, w), normalized here
+        """
+        pose = cls.__new__(cls)
+        pose._set(t, quat)
+        return pose
 
     @classmethod
     def from_xyzrpy(cls, xyzrpy):
@@ -46,17 +69,30 @@ class SE3:
 
     @classmethod
     def from_xyzquat(cls, t, quat):
-        R = Rotation.from_quat(quat)
-        return cls(t, R)
+        return cls.from_arrays(t, quat)
 
     @classmethod
     def from_mat(cls, T):
-        R = Rotation.from_quat(T[:, :3, :3])
-        t = T[:, :3, 3]
-        return cls(t, R)
+        """
+        Args:
+            T (N x 4 x 4 or 4 x 4) : stacked homogeneous transformation matrices
+        """
+        T = np.asarray(T)
+        # older scipy versions name it `from_dcm`
+        from_matrix = getattr(Rotation, "from_matrix", None) or Rotation.from_dcm
+        return cls(T[..., :3, 3], from_matrix(T[..., :3, :3]))
+
+    @classmethod
+    def concatenate(cls, poses):
+        """
+        Stacks a sequence of SE3 objects, each holding one or several poses.
+        """
+        t = np.concatenate([pose.translations() for pose in poses])
+        quat = np.concatenate([pose.quaternions() for pose in poses])
+        return cls.from_arrays(t, quat)
 
     def __getitem__(self, indexer):
-        return self.__class__(self.t()[indexer], self.R()[indexer])
+        return self.from_arrays(self._t[indexer], self._q[indexer])
 
     def __len__(self):
         return self.len
@@ -65,51 +101,66 @@ class SE3:
         """
         Performs element-wise pose composition.
         """
-        if not (len(self) == 1 or len(other) == 1 or len(self) == len(other)):
-            raise ValueError(
-                "Expected equal number of transformations in both "
-                "or a single transformation in either object, "
-                "got {} transformations in first and {} transformations in "
-                "second object.".format(len(self), len(other))
-            )
-        return self.__class__(
-            self.R().apply(other.t()) + self.t(), self.R() * other.R()
-        )
+        _check_sizes(self, other)
+        q1, q2 = self.quaternions(), other.quaternions()
+        t = quat_apply(q1, other.translations()) + self.translations()
+        return self._from_result(t, quat_multiply(q1, q2))
 
     def __truediv__(self, other):
         """
         Computes relative pose, similar to MATLAB convention
         (x = A \ b for Ax = b). Example:
         T1 / T2 = T1.inv() * T2
-        TO DO: Broadcasting
         """
-        if not (len(self) == 1 or len(other) == 1 or len(self) == len(other)):
-            raise ValueError(
-                "Expected equal number of transformations in both "
-                "or a single transformation in either object, "
-                "got {} transformations in first and {} transformations in "
-                "second object.".format(len(self), len(other))
-            )
-        R1_inv = self.R().inv()
-        t_new = R1_inv.apply(other.t() - self.t())
-        return self.__class__(t_new, R1_inv * other.R())
+        _check_sizes(self, other)
+        q1_inv = quat_conjugate(self.quaternions())
+        t = quat_apply(q1_inv, other.translations() - self.translations())
+        return self._from_result(t, quat_multiply(q1_inv, other.quaternions()))
+
+    def _from_result(self, t, quat):
+        # results of length one are single poses, as in the constructor
+        if len(t) == 1:
+            t, quat = t[0], quat[0]
+        return self.from_arrays(t, quat)
 
     def t(self):
         return self._t[0] if self._single else self._t
 
+    def quat(self):
+        return self._q[0] if self._single else self._q
+
+    def translations(self):
+        """Translations as a N x 3 array, also for a single pose."""
+        return self._t
+
+    def quaternions(self):
+        """Quaternions as a N x 4 array, also for a single pose."""
+        return self._q
+
     def R(self):
-        return self._R
+        return Rotation.from_quat(self.quat())
 
     def inv(self):
-        R_inv = self.R().inv()
-        t_new = -R_inv.apply(self.t())
-        return SE3(t_new, R_inv)
+        q_inv = quat_conjugate(self.quat())
+        t_new = -quat_apply(q_inv, self.t())
+        return self.from_arrays(t_new, q_inv)
 
     def components(self):
         return self.t(), self.R()
 
     def magnitude(self):
-        return np.linalg.norm(self.t(), axis=-1), self.R().magnitude()
+        return np.linalg.norm(self.t(), axis=-1), quat_angle(self.quat())
+
+    def as_mat(self):
+        """
+        Returns:
+            T (N x 4 x 4 or 4 x 4) : homogeneous transformation matrices
+        """
+        T = np.zeros(self._t.shape[:-1] + (4, 4))
+        T[:, :3, :3] = quat_to_matrix(self._q)
+        T[:, :3, 3] = self._t
+        T[:, 3, 3] = 1
+        return T[0] if self._single else T
 
     def to_list(self):
         if len(self) == 1:
@@ -118,6 +169,76 @@ class SE3:
             return [pose for pose in self]
 
 
+def _check_sizes(p1, p2):
+    if not (len(p1) == 1 or len(p2) == 1 or len(p1) == len(p2)):
+        raise ValueError(
+            "Expected equal number of transformations in both "
+            "or a single transformation in either object, "
+            "got {} transformations in first and {} transformations in "
+            "second object.".format(len(p1), len(p2))
+        )
+
+
+def quat_conjugate(q):
+    return np.concatenate([-q[..., :3], q[..., 3:]], axis=-1)
+
+
+def quat_multiply(q1, q2):
+    """
+    Hamilton product of broadcastable arrays of quaternions (x, y, z, w).
+    """
+    v1, w1 = q1[..., :3], q1[..., 3:]
+    v2, w2 = q2[..., :3], q2[..., 3:]
+    v = w1 * v2 + w2 * v1 + np.cross(v1, v2)
+    w = w1 * w2 - np.sum(v1 * v2, axis=-1, keepdims=True)
+    return np.concatenate([v, w], axis=-1)
+
+
+def quat_apply(q, x):
+    """
+    Rotates broadcastable arrays of vectors x by unit quaternions q.
+    """
+    v, w = q[..., :3], q[..., 3:]
+    uv = 2 * np.cross(v, x)
+    return x + w * uv + np.cross(v, uv)
+
+
+def quat_angle(q):
+    """
+    Rotation angle in radians of unit quaternions, same as
+    `Rotation.magnitude`.
+    """
+    return 2 * np.arctan2(np.linalg.norm(q[..., :3], axis=-1), np.abs(q[..., 3]))
+
+
+def quat_to_matrix(q):
+    x, y, z, w = np.moveaxis(q, -1, 0)
+    R = np.stack(
+        [
+            1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w),
+            2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w),
+            2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y),
+        ],
+        axis=-1,
+    )
+    return R.reshape(q.shape[:-1] + (3, 3))
+
+
+def relative_error(t1, q1, t2, q2):
+    """
+    Translation and rotation (radians) magnitudes of the relative poses
+    between broadcastable arrays of translations and quaternions.
+    """
+    t_err = np.linalg.norm(t2 - t1, axis=-1)
+    # vector part and scalar part of conj(q1) * q2
+    v1, w1 = q1[..., :3], q1[..., 3:]
+    v2, w2 = q2[..., :3], q2[..., 3:]
+    v = w1 * v2 - w2 * v1 - np.cross(v1, v2)
+    w = np.sum(v1 * v2, axis=-1) + w1[..., 0] * w2[..., 0]
+    R_err = 2 * np.arctan2(np.linalg.norm(v, axis=-1), np.abs(w))
+    return t_err, R_err
+
+
 def metric(p1, p2, w):
     """
     Computes metric on the cartesian product space representation of
@@ -127,37 +248,131 @@ def metric(p1, p2, w):
         p2 (SE3) : set of poses (same size as p1)
         w (float > 0) : weight for attitude component
     """
-    if not (len(p1) == 1 or len(p2) == 1 or len(p1) == len(p2)):
-        raise ValueError(
-            "Expected equal number of transformations in"
-            "both or a single transformation in either"
-            "object, got {} transformations in first and"
-            "{} transformations in second object.".format(len(p1), len(p2))
-        )
     if w < 0:
         raise ValueError("Weight must be non-negative, currently {}".format(w))
-    p_rel = p1 / p2
-    t_dist = np.linalg.norm(p_rel.t(), axis=-1)
-    R_dist = p_rel.R().magnitude()
+    t_dist, R_dist = error(p1, p2)
     return t_dist + w * R_dist
 
 
 def error(p1, p2):
-    if not (len(p1) == 1 or len(p2) == 1 or len(p1) == len(p2)):
-        raise ValueError(
-            "Expected equal number of transformations in both "
-            "or a single transformation in either object, "
-            "got {} transformations in first and {}"
-            "transformations in second object.".format(len(p1), len(p2))
-        )
-    p_rel = p1 / p2
-    return p_rel.magnitude()
+    _check_sizes(p1, p2)
+    t_err, R_err = relative_error(
+        p1.translations(), p1.quaternions(), p2.translations(), p2.quaternions()
+    )
+    if p1._single and p2._single:
+        return t_err[0], R_err[0]
+    return t_err, R_err
+
+
+def _pairwise_chunks(p1, p2, chunk_size):
+    t2, q2 = p2.translations()[None], p2.quaternions()[None]
+    for start in range(0, len(p1), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        t1 = p1.translations()[chunk, None]
+        q1 = p1.quaternions()[chunk, None]
+        yield chunk, relative_error(t1, q1, t2, q2)
+
+
+def pairwise_error(p1, p2, chunk_size=256):
+    """
+    Errors between all pairs of poses, computed in chunks of p1 to bound
+    memory.
+    Args:
+        p1 (SE3) : N poses
+        p2 (SE3) : M poses
+    Returns:
+        t_err, R_err (N x M) : translation and rotation (radians) errors
+    """
+    t_err = np.empty((len(p1), len(p2)))
+    R_err = np.empty((len(p1), len(p2)))
+    for chunk, (t, R) in _pairwise_chunks(p1, p2, chunk_size):
+        t_err[chunk], R_err[chunk] = t, R
+    return t_err, R_err
+
+
+def pairwise_metric(p1, p2, w, chunk_size=256):
+    """
+    Metric between all pairs of poses, see `metric`.
+    Returns:
+        dist (N x M)
+    """
+    if w < 0:
+        raise ValueError("Weight must be non-negative, currently {}".format(w))
+    dist = np.empty((len(p1), len(p2)))
+    for chunk, (t, R) in _pairwise_chunks(p1, p2, chunk_size):
+        dist[chunk] = t + w * R
+    return dist
+
+
+def smallest(values, k, ind=None):
+    """
+    Positions of the k smallest values in increasing order, ties broken by
+    increasing ind (defaults to the positions) so that the result does not
+    depend on the order of the candidates.
+    """
+    if ind is None:
+        ind = np.arange(len(values))
+    return np.lexsort((ind, values))[:k]
+
+
+class PoseIndex:
+    """
+    KD-tree over the translations of a set of poses answering k-nearest
+    neighbour queries under `metric` and tolerance queries under `error`.
+    Since the translation error lower bounds the metric, rotation errors are
+    only computed for the poses within the translation bound, and results
+    are identical to an exhaustive search.
+    """
+
+    def __init__(self, poses, min_candidates=32):
+        self.poses = poses
+        self.tree = cKDTree(poses.translations())
+        self.min_candidates = min_candidates
+
+    def __len__(self):
+        return len(self.poses)
+
+    def knn(self, pose, k, w):
+        """
+        Returns:
+            ind (k,) : indices of the nearest poses, by increasing metric
+            dist (k,) : their metric to the query pose
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.empty(0, dtype=int), np.empty(0)
+        t = pose.translations()[0]
+        num_candidates = min(len(self), max(4 * k, self.min_candidates))
+        t_dist, ind = self.tree.query(t, num_candidates)
+        ind = np.atleast_1d(ind)
+        dist = np.atleast_1d(metric(pose, self.poses[ind], w))
+        kth = np.partition(dist, k - 1)[k - 1]
+        if num_candidates < len(self) and not np.max(t_dist) > kth:
+            # poses outside of the candidates may be closer, the metric
+            # bounds their translation error
+            ind = np.array(self.tree.query_ball_point(t, kth * (1 + 1e-9) + 1e-12))
+            dist = np.atleast_1d(metric(pose, self.poses[ind], w))
+        match = smallest(dist, k, ind)
+        return ind[match], dist[match]
+
+    def within(self, pose, t, R):
+        """
+        Poses with translation error below t (meters) and rotation error
+        below R (degrees), in increasing index order.
+        Returns:
+            ind, t_err, R_err (radians)
+        """
+        ind = np.sort(self.tree.query_ball_point(pose.translations()[0], t))
+        ind = ind.astype(int)
+        t_err, R_err = error(pose, self.poses[ind])
+        t_err, R_err = np.atleast_1d(t_err), np.atleast_1d(R_err)
+        match = np.logical_and(t_err < t, R_err * 180 / np.pi < R)
+        return ind[match], t_err[match], R_err[match]
 
 
 def combine(listOfPoses):
-    tList = []
-    qList = []
-    for pose in listOfPoses:
-        tList.append(pose.t())
-        qList.append(pose.R().as_quat())
-    return SE3(np.asarray(tList), Rotation.from_quat(np.asarray(qList)))
+    """
+    Stacks a list of SE3 objects, each holding one or several poses, into
+    a single SE3 object.
+    """
+    return SE3.concatenate(listOfPoses)
@@ -10,31 +10,30 @@ logging.basicConfig(format='[%(asctime)s %(levelname)s] %(message)s',
 from hfnet.datasets import get_dataset  # noqa: E402
 from hfnet.evaluation.loaders import export_loader  # noqa: E402
 from hfnet.settings import EXPER_PATH  # noqa: E402
+from hfnet.utils.writer import NpzWriter  # noqa: E402
 
 
-def export_for_sfm(data_config, exper_config, export_name):
+def export_for_sfm(data_config, exper_config, export_name, num_writers=2):
     export_dir = Path(EXPER_PATH, 'exports', export_name)
     export_dir.mkdir(exist_ok=True)
 
     dataset = get_dataset(data_config['name'])(**data_config)
     data_iter = dataset.get_test_set()
-
-    for data in tqdm(data_iter):
-        predictions = exper_config['predictor'](
-            data['image'], data['name'], **exper_config)
-        # Scale the keypoints to the original image size
-        # and convert to Colmap convention (origin = corner of upper left pix)
-        scale = ((np.array(data['original_size'][:2]) - 1)
-                 / (np.array(data['image'].shape[:2]) - 1))
-        export = {
-            'keypoints': scale[::-1] * predictions['keypoints'] + 0.5,
-            'scores': predictions['scores'],
-            'descriptors': predictions['descriptors'],
-            'image_size': data['image'].shape[:2][::-1]
-        }
-        name = data['name'].decode('utf-8')
-        Path(export_dir, Path(name).parent).mkdir(parents=True, exist_ok=True)
-        np.savez(Path(export_dir, f'{name}.npz'), **export)
+    with NpzWriter(export_dir, num_workers=num_writers) as writer:
+        for data in tqdm(data_iter):
+            predictions = exper_config['predictor'](
+                data['image'], data['name'], **exper_config)
+            # Scale the keypoints to the original image size and convert
+            # to Colmap convention (origin = corner of upper left pix)
+            scale = ((np.array(data['original_size'][:2]) - 1)
+                     / (np.array(data['image'].shape[:2]) - 1))
+            export = {
+                'keypoints': scale[::-1] * predictions['keypoints'] + 0.5,
+                'scores': predictions['scores'],
+                'descriptors': predictions['descriptors'],
+                'image_size': data['image'].shape[:2][::-1]
+            }
+            writer.write(data['name'].decode('utf-8'), export)
 
 
 if __name__ == '__main__':
@@ -42,6 +41,7 @@ if __name__ == '__main__':
     parser.add_argument('dataset', type=str)
     parser.add_argument('export_name', type=str)
     parser.add_argument('new_export_name', type=str)
+    parser.add_argument('--num_writers', type=int, default=2)
     args = parser.parse_args()
 
     data_configs = {
@@ -75,4 +75,5 @@ if __name__ == '__main__':
     }
 
     export_for_sfm(
-        data_configs[args.dataset], exper_config, args.new_export_name)
+        data_configs[args.dataset], exper_config, args.new_export_name,
+        num_writers=args.num_writers)
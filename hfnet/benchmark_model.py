@@ -0,0 +1,153 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import resource
+import time
+import numpy as np
+
+logging.basicConfig(format='[%(asctime)s %(levelname)s] %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+
+# Outputs fetched for each head subset
+OUTPUT_SUBSETS = {
+    'global': ['global_descriptor'],
+    'local': ['keypoints', 'scores', 'local_descriptors'],
+    'both': ['global_descriptor', 'keypoints', 'scores', 'local_descriptors'],
+}
+
+
+def load_image(path, size, channels):
+    import cv2
+    h, w = size
+    image = cv2.resize(cv2.imread(path), (w, h))
+    if channels == 1:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)[..., None]
+    return image.astype(np.float32)
+
+
+def run_config(config):
+    """Times a SavedModel or a frozen graph with one setting, in a fresh
+       process such that the peak memory is specific to this setting.
+    """
+    import tensorflow as tf
+    from tensorflow.python.saved_model import tag_constants
+    tf.contrib.resampler  # import C++ op
+
+    sess_config = tf.ConfigProto(
+        intra_op_parallelism_threads=config['intra_threads'],
+        inter_op_parallelism_threads=config['inter_threads'],
+        device_count={'GPU': 0 if config['use_cpu'] else 1},
+        allow_soft_placement=True)
+    with tf.Session(graph=tf.Graph(), config=sess_config) as sess:
+        if config['model'].endswith('.pb'):  # frozen graph
+            graph_def = tf.GraphDef()
+            with open(config['model'], 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            # Exported models are pinned to /gpu:0
+            for node in graph_def.node:
+                node.device = ''
+            tf.import_graph_def(graph_def, name='')
+        else:
+            tf.saved_model.loader.load(
+                sess, [tag_constants.SERVING], config['model'],
+                clear_devices=True)
+        graph = tf.get_default_graph()
+        image_tensor = graph.get_tensor_by_name('image:0')
+        try:
+            outputs = [graph.get_tensor_by_name(n+':0')
+                       for n in OUTPUT_SUBSETS[config['outputs']]]
+        except KeyError:
+            return None  # the model does not have these heads
+
+        channels = image_tensor.shape[-1].value or 1
+        if config['image']:
+            image = load_image(config['image'], config['input_size'], channels)
+        else:
+            image = np.random.RandomState(0).uniform(
+                0, 255, config['input_size'] + [channels]).astype(np.float32)
+        feed = {image_tensor: np.stack([image]*config['batch_size'])}
+
+        for _ in range(config['warmup']):
+            sess.run(outputs, feed_dict=feed)
+        durations = []
+        for _ in range(config['iterations']):
+            start = time.perf_counter()
+            sess.run(outputs, feed_dict=feed)
+            durations.append(time.perf_counter() - start)
+
+    durations = 1e3*np.array(durations)
+    return {
+        **{k: config[k] for k in ['model', 'input_size', 'batch_size',
+                                  'intra_threads', 'inter_threads', 'outputs']},
+        'latency_ms': {
+            'mean': np.mean(durations),
+            'p50': np.percentile(durations, 50),
+            'p95': np.percentile(durations, 95),
+            'p99': np.percentile(durations, 99),
+        },
+        'throughput': config['batch_size'] * 1e3 / np.mean(durations),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('models', type=str, nargs='+',
+                        help='SavedModel directories or frozen .pb graphs')
+    parser.add_argument('--image', type=str)
+    parser.add_argument('--input_sizes', type=str, nargs='+',
+                        default=['960x720'], help='HxW')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1],
+                        help='sizes above 1 require a model exported '
+                        'with batched_extraction to time the local head')
+    parser.add_argument('--intra_threads', type=int, nargs='+', default=[0],
+                        help='0 lets TensorFlow choose')
+    parser.add_argument('--inter_threads', type=int, nargs='+', default=[0])
+    parser.add_argument('--outputs', type=str, nargs='+', default=['both'],
+                        choices=list(OUTPUT_SUBSETS))
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--use_cpu', action='store_true')
+    parser.add_argument('--output_file', type=str,
+                        help='JSON file of the results, printed otherwise')
+    args = parser.parse_args()
+
+    settings = itertools.product(
+        args.models, args.input_sizes, args.batch_sizes, args.intra_threads,
+        args.inter_threads, args.outputs)
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for model, size, batch, intra, inter, outputs in settings:
+        config = {
+            'model': model,
+            'input_size': [int(s) for s in size.split('x')],
+            'batch_size': batch, 'intra_threads': intra,
+            'inter_threads': inter, 'outputs': outputs,
+            'image': args.image, 'iterations': args.iterations,
+            'warmup': args.warmup, 'use_cpu': args.use_cpu,
+        }
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_config, (config,))
+        if result is None:
+            logging.info(f'Skipping {outputs} outputs of {model}.')
+            continue
+        lat = result['latency_ms']
+        logging.info(
+            f'{model} {size} batch {batch} threads {intra}/{inter} '
+            f'{outputs}: p50 {lat["p50"]:.2f}ms, p99 {lat["p99"]:.2f}ms, '
+            f'{result["throughput"]:.2f} im/s, '
+            f'{result["peak_rss_mb"]:.0f}MB')
+        results.append(result)
+
+    report = {'use_cpu': args.use_cpu, 'iterations': args.iterations,
+              'warmup': args.warmup, 'results': results}
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -88,6 +88,8 @@ if __name__ == '__main__':
     parser.add_argument('--max_iter', type=int)
     parser.add_argument('--export_poses', action='store_true')
     parser.add_argument('--cpp_backend', action='store_true')
+    parser.add_argument('--match_cache', type=str,
+                        help='file caching the local matches across runs')
     args = parser.parse_args()
 
     config = {
@@ -99,6 +101,8 @@ if __name__ == '__main__':
         'max_iter': args.max_iter,
         'queries': args.queries,
         'use_cpp': args.cpp_backend,
+        'match_cache': (None if args.match_cache is None
+                        else {'path': args.match_cache}),
     }
     logging.info('Evaluating Robotcar with configuration: \n'+pformat(config))
     loc = Localization('robotcar', args.model, config, build_db=args.build_db)
@@ -5,33 +5,70 @@ import logging
 from .utils.localization import LocResult
 
 
+def image_arrays(db_ids, local_db, global_descriptors):
+    """Flattens the database images into the CSR layout of `HLoc.addImages`.
+    """
+    num_kpts = np.array([len(local_db[i].keypoints) for i in db_ids])
+    offsets = np.concatenate([[0], np.cumsum(num_kpts)]).astype(np.int32)
+    keypoints = np.concatenate(
+        [local_db[i].keypoints for i in db_ids]).astype(np.float32)
+    local_desc = np.concatenate(
+        [local_db[i].descriptors for i in db_ids]).astype(np.float32)
+    global_desc = global_descriptors.astype(np.float32, copy=False)
+    return global_desc, keypoints, local_desc, offsets
+
+
+def point_arrays(db_ids, images, points):
+    """Flattens the 3D points and their tracks into the CSR layout of
+       `HLoc.add3dPoints`. Keypoint indices of the COLMAP images are remapped
+       to indices among the keypoints that observe a 3D point.
+    """
+    # Per-image rank of each keypoint among the valid ones
+    valid = [images[i].point3D_ids >= 0 for i in db_ids]
+    image_offsets = np.concatenate([[0], np.cumsum([len(v) for v in valid])])
+    new_kpt_idx = np.concatenate([np.cumsum(v) - 1 for v in valid])
+
+    id_to_idx = np.full(np.max(db_ids)+1, -1, dtype=np.int64)
+    id_to_idx[db_ids] = np.arange(len(db_ids))
+
+    pts = list(points.values())
+    xyz = np.stack([pt.xyz for pt in pts]).astype(np.float32)
+    track_lengths = np.array([len(pt.image_ids) for pt in pts])
+    obs_offsets = np.concatenate(
+        [[0], np.cumsum(track_lengths)]).astype(np.int32)
+    obs_image_ids = np.concatenate([pt.image_ids for pt in pts])
+    obs_kpt_ids = np.concatenate([pt.point2D_idxs for pt in pts])
+
+    obs_image_idx = id_to_idx[obs_image_ids]
+    assert np.all(obs_image_idx >= 0), 'Point observed by an unknown image'
+    obs_kpt_idx = new_kpt_idx[image_offsets[obs_image_idx] + obs_kpt_ids]
+    observations = np.stack([obs_image_idx, obs_kpt_idx], -1).astype(np.int32)
+    return xyz, observations, obs_offsets
+
+
 class CppLocalization:
-    def __init__(self, db_ids, local_db, global_descriptors, images, points):
+    def __init__(self, db_ids, local_db, global_descriptors, images, points,
+                 global_index='kdtree', num_lists=0, num_probes=8,
+                 component_ordering='retrieval', descriptor_type='float32',
+                 chunk_size=1000, verbose=False):
         import _hloc_cpp
-        self.hloc = _hloc_cpp.HLoc()
+        self.hloc = _hloc_cpp.HLoc(descriptor_type)
+        self.hloc.setVerbose(verbose)
+        self.verbose = verbose
 
-        id_to_idx = {}
-        old_to_new_kpt = {}
-        for idx, i in enumerate(db_ids):
-            keypoints = local_db[i].keypoints.T.astype(np.float32).copy()
-            local_desc = local_db[i].descriptors.T.astype(np.float32).copy()
-            global_desc = global_descriptors[idx].astype(np.float32).copy()
+        # Images are added in chunks to bound the memory of the flat arrays
+        for start in range(0, len(db_ids), chunk_size):
+            chunk = slice(start, start+chunk_size)
+            global_desc, keypoints, local_desc, offsets = image_arrays(
+                db_ids[chunk], local_db, global_descriptors[chunk])
             # keypoints are NOT undistorted or nomalized
-            idx = self.hloc.addImage(global_desc, keypoints, local_desc)
-
-            id_to_idx[i] = idx
-            old_to_new_kpt[i] = {
-                k: j for j, k
-                in enumerate(np.where(images[i].point3D_ids >= 0)[0])}
+            self.hloc.addImages(
+                global_desc.T, keypoints.T, local_desc.T, offsets)
 
-        for i, pt in points.items():
-            observations = np.array(
-                [[id_to_idx[im_id], old_to_new_kpt[im_id][kpt_id]]
-                 for im_id, kpt_id in zip(pt.image_ids, pt.point2D_idxs)],
-                dtype=np.int32)
-            self.hloc.add3dPoint(
-                pt.xyz.astype(np.float32).copy(), observations.copy())
-        self.hloc.buildIndex()
+        xyz, observations, obs_offsets = point_arrays(db_ids, images, points)
+        self.hloc.add3dPoints(xyz.T, observations.T, obs_offsets)
+        self.hloc.buildIndex(
+            global_index, num_lists, num_probes, component_ordering)
 
     def localize(self, query_info, query_item, global_transf, local_transf):
         global_desc = global_transf(query_item.global_desc[np.newaxis])[0]
@@ -40,30 +77,15 @@ class CppLocalization:
             query_item.keypoints[np.newaxis], query_info.K,
             np.array([query_info.dist, 0, 0, 0]))[0]
 
-        logging.info('Localizing image %s', query_info.name)
-        ret = self.cpp_backend.localize(
+        if self.verbose:
+            logging.info('Localizing image %s', query_info.name)
+        stats = self.hloc.localize(
             global_desc.astype(np.float32),
             keypoints.astype(np.float32).T.copy(),
             local_desc.astype(np.float32).T.copy())
-        (success, num_components_total, num_components_tested,
-         last_component_size, num_db_landmarks, num_matches,
-         num_inliers, num_iters, global_ms, covis_ms, local_ms, pnp_ms) = ret
 
-        result = LocResult(success, num_inliers, 0, np.eye(4))
-        stats = {
-            'success': success,
-            'num_components_total': num_components_total,
-            'num_components_tested': num_components_tested,
-            'last_component_size': last_component_size,
-            'num_db_landmarks': num_db_landmarks,
-            'num_matches': num_matches,
-            'num_inliers': num_inliers,
-            'num_ransac_iters': num_iters,
-            'timings': {
-                'global': global_ms,
-                'covis': covis_ms,
-                'local': local_ms,
-                'pnp': pnp_ms,
-            }
-        }
+        # Seconds, as for the Python backend
+        stats['timings'] = {
+            k: v * 1e-6 for k, v in stats.pop('timings_us').items()}
+        result = LocResult(stats['success'], stats['num_inliers'], 0, np.eye(4))
         return (result, stats)
@@ -6,6 +6,7 @@ from .utils.keypoints import (
     keypoints_filter_borders, nms_fast, keypoints_cv2np)
 from .utils.descriptors import sample_descriptors, root_descriptors
 from hfnet.settings import EXPER_PATH
+from hfnet.utils.export_store import ExportStore
 
 
 def sift_loader(image, name, **config):
@@ -63,6 +64,33 @@ def harris_loader(image, name, **config):
     return {'keypoints': kpts, 'scores': scores}
 
 
+_export_stores = {}
+
+
+def open_export_store(experiment):
+    """Store of the exports of an experiment, opened once and reopened when
+       its index files change, e.g. after an export was resumed.
+    """
+    base_dir = Path(EXPER_PATH, 'exports', experiment)
+    state = tuple((p.name, p.stat().st_mtime_ns, p.stat().st_size)
+                  for p in ExportStore.index_paths(base_dir))
+    if experiment in _export_stores:
+        cached_state, store = _export_stores[experiment]
+        if cached_state == state:
+            return store
+        store.close()
+        del _export_stores[experiment]
+    store = ExportStore(base_dir)
+    _export_stores[experiment] = (state, store)
+    return store
+
+
+def close_export_stores():
+    for _, store in _export_stores.values():
+        store.close()
+    _export_stores.clear()
+
+
 def export_loader(image, name, experiment, **config):
     has_keypoints = config.get('has_keypoints', True)
     has_descriptors = config.get('has_descriptors', True)
@@ -74,12 +102,16 @@ def export_loader(image, name, experiment, **config):
     nms_thresh = config.get('nms_thresh', 4)
     keypoint_refinement = config.get('keypoint_refinement', False)
     binarize = config.get('binarize', False)
+    export_format = config.get('export_format', 'npz')
     entries = ['keypoints', 'scores', 'descriptors', 'local_descriptors']
 
     name = name.decode('utf-8') if isinstance(name, bytes) else name
-    path = Path(EXPER_PATH, 'exports', experiment, name+'.npz')
-    with np.load(path) as p:
-        pred = {k: v.copy() for k, v in p.items()}
+    if export_format == 'pack':
+        pred = open_export_store(experiment).read(name)
+    else:
+        path = Path(EXPER_PATH, 'exports', experiment, name+'.npz')
+        with np.load(path) as p:
+            pred = {k: v.copy() for k, v in p.items()}
     image_shape = image.shape[:2]
     if keypoint_predictor:
         keypoint_config = config.get('keypoint_config', config)
@@ -121,6 +153,10 @@ def export_loader(image, name, experiment, **config):
                 pred['local_descriptor_map'], pred['keypoints'], image_shape,
                 input_shape=pred['input_shape'][:2] if 'input_shape' in pred
                 else None)
+    # Half precision exports are upcast only for the kept descriptors
+    for k in ['descriptors', 'global_descriptor']:
+        if k in pred and pred[k].dtype == np.float16:
+            pred[k] = pred[k].astype(np.float32)
     if binarize:
         pred['descriptors'] = pred['descriptors'] > 0
     return pred
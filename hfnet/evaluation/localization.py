@@ -11,8 +11,9 @@ from .utils.db_management import (
     read_query_list, extract_query, build_localization_dbs,
     colmap_image_to_pose)
 from .utils.localization import (
-    covis_clustering, match_against_place, do_pnp, preprocess_globaldb,
-    preprocess_localdb, loc_failure, LocResult)
+    covis_clustering, cached_match_against_place, do_pnp,
+    preprocess_globaldb, preprocess_localdb, loc_failure, LocResult,
+    MatchCache)
 from .utils.descriptors import topk_matching
 from hfnet.datasets.colmap_utils.read_model import read_model
 from .cpp_localization import CppLocalization
@@ -95,14 +96,27 @@ class Localization:
         self.dataset_name = dataset_name
         self.config = config
 
+        # Opt-in cache of the local matches, e.g. {'max_size': 10000,
+        # 'path': 'matches.pkl'}
+        config_cache = config.get('match_cache')
+        self.match_cache = (
+            None if config_cache is None else MatchCache(**config_cache))
+
         self.use_cpp = config.get('use_cpp', False)
         if self.use_cpp:
             self.init_cpp()
 
     def init_cpp(self):
+        config_cpp = self.config.get('cpp', {}).copy()
+        release_python_db = config_cpp.pop('release_python_db', False)
         self.cpp_backend = CppLocalization(
             self.db_ids, self.local_db, self.global_descriptors,
-            self.images, self.points)
+            self.images, self.points, **config_cpp)
+        if release_python_db:
+            # The C++ map holds its own copy of the databases
+            logging.info('Releasing the Python databases')
+            self.local_db = None
+            self.global_descriptors = None
 
     def init_queries(self, query_file, query_config, prefix=''):
         queries = read_query_list(
@@ -154,10 +168,9 @@ class Localization:
         for place in clustered_frames:
             # Local matching
             matches_data = {} if debug else None
-            matches, place_lms, duration = match_against_place(
-                place, self.local_db, local_desc, config_local['ratio_thresh'],
-                do_fast_matching=config_local.get('fast_matching', True),
-                debug_dict=matches_data)
+            matches, place_lms, duration = cached_match_against_place(
+                self.match_cache, query_info.name, place, self.local_db,
+                local_desc, config_local, debug_dict=matches_data)
             timings['local'] += duration
 
             # PnP
@@ -220,6 +233,11 @@ def evaluate(loc, queries, query_dataset, max_iter=None):
             if len(results) == max_iter:
                 break
 
+    if loc.match_cache is not None:
+        logging.info(f'Match cache: {loc.match_cache.hits} hits, '
+                     f'{loc.match_cache.misses} misses')
+        loc.match_cache.save()
+
     success = np.array([r.success for r in results])
     num_inliers = np.array([r.num_inliers for r in results])
     ratios = np.array([r.inlier_ratio for r in results])
@@ -3,36 +3,74 @@ import numpy as np
 from .misc import from_homogeneous, to_homogeneous
 
 
-def nms_fast(kpts, scores, shape, dist_thresh=4):
-    grid = np.zeros(shape, dtype=int)
-    inds = np.zeros(shape, dtype=int)
-
+def nms_fast(kpts, scores, shape, dist_thresh=4, chunk_size=1024):
     inds1 = np.argsort(-scores)  # Sort by confidence
-    kpts_sorted = kpts[inds1]
-    kpts_sorted = kpts_sorted.round().astype(int)  # Rounded corners.
 
     # Check for edge case of 0 or 1 corners.
-    if kpts_sorted.shape[0] == 0:
+    if len(inds1) == 0:
         return np.zeros(0, dtype=int)
-    if kpts_sorted.shape[0] == 1:
+    if len(inds1) == 1:
         return np.zeros((1), dtype=int)
 
-    grid[kpts_sorted[:, 1], kpts_sorted[:, 0]] = 1
-    inds[kpts_sorted[:, 1], kpts_sorted[:, 0]] = np.arange(len(kpts_sorted))
+    # Flat indices of the rounded corners in the padded grid, sorted.
     pad = dist_thresh
-    grid = np.pad(grid, [[pad]*2]*2, mode='constant')
-
-    # Iterate through points, highest to lowest conf, suppress neighborhood.
-    for i, k in enumerate(kpts_sorted):
-        pt = (k[0]+pad, k[1]+pad)
-        if grid[pt[1], pt[0]] == 1:
-            grid[pt[1]-pad:pt[1]+pad+1, pt[0]-pad:pt[0]+pad+1] = 0
-            grid[pt[1], pt[0]] = -1
-
-    keepy, keepx = np.where(grid == -1)
-    keepy, keepx = keepy - pad, keepx - pad
-    inds_keep = inds[keepy, keepx]
-    scores_keep = scores[inds1][inds_keep]
+    width = shape[1] + 2*pad
+    kpts = np.asarray(kpts).round().astype(int)
+    cells = ((kpts[:, 1]+pad)*width + kpts[:, 0]+pad)[inds1]
+
+    # A pixel with several corners is visited at the rank of the first one
+    # but represented by the last one.
+    ranks = np.arange(len(cells))
+    inds = np.empty((shape[0]+2*pad)*width, dtype=int)
+    inds[cells] = ranks
+    if not np.all(inds[cells] == ranks):
+        inds[cells[::-1]] = ranks[::-1]
+        first = inds[cells] == ranks
+        inds[cells] = ranks
+        cells = cells[first]
+
+    # 1: corner, 0: suppressed, -1: kept, 2+i: i-th corner of the chunk
+    grid = np.zeros(len(inds), dtype=np.int32)
+    grid[cells] = 1
+    dy, dx = np.mgrid[-pad:pad+1, -pad:pad+1]
+    window = (dy*width + dx).ravel()
+    neighborhood = window[len(window)//2+1:]  # following pixels only
+
+    # Process the corners by chunks, highest to lowest conf. Within a chunk,
+    # a corner is kept if none of its higher conf neighbors is kept: each
+    # round decides the corners whose higher neighbors are all decided.
+    keep = []
+    for start in range(0, len(cells), chunk_size):
+        chunk = cells[start:start+chunk_size]
+        chunk = chunk[grid[chunk] == 1]  # not yet suppressed
+        num = len(chunk)
+        if num == 0:
+            continue
+        grid[chunk] = np.arange(2, num+2)
+        neighbors = grid[chunk[:, None] + neighborhood] - 2
+        grid[chunk] = 1
+        i, j = np.nonzero(neighbors >= 0)
+        j = neighbors[i, j]
+        higher, lower = np.minimum(i, j), np.maximum(i, j)
+
+        state = np.zeros(num, dtype=int)  # 1: kept, -1: suppressed
+        while len(higher):
+            blocked = np.zeros(num, dtype=bool)
+            blocked[lower] = True
+            kept = (state == 0) & ~blocked
+            state[kept] = 1
+            state[lower[kept[higher]]] = -1
+            active = (state[higher] == 0) & (state[lower] == 0)
+            higher, lower = higher[active], lower[active]
+        kept = chunk[state >= 0]
+        keep.append(kept)
+        if start + chunk_size < len(cells):
+            grid[kept[:, None] + window] = 0
+            grid[kept] = -1
+
+    keep = np.sort(np.concatenate(keep))  # row-major order
+    inds_keep = inds[keep]
+    scores_keep = scores[inds1[inds_keep]]
 
     inds2 = np.argsort(-scores_keep)
     out_inds = inds1[inds_keep[inds2]]
@@ -1,7 +1,11 @@
 import numpy as np
 import cv2
+import os
+import pickle
+import logging
+from pathlib import Path
 from sklearn.decomposition import PCA
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from .descriptors import (
     normalize, root_descriptors, fast_matching, matches_cv2np)
@@ -128,6 +132,119 @@ def match_against_place(frame_ids, local_db, query_desc, ratio_thresh,
     return matches, place_lms, duration
 
 
+class MatchCache:
+    """Bounded cache of the results of `match_against_place`, evicting the
+       least recently used entries. Entries are keyed by the query name, the
+       sorted frame ids of the place, the ratio threshold and the local
+       descriptor configuration. The matches of a hit are remapped to the
+       order of the frames of the request. If a path is given, the cache is
+       loaded from and saved to this file.
+    """
+    def __init__(self, max_size=10000, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+        if path is not None and Path(path).exists():
+            with open(path, 'rb') as f:
+                entries = pickle.load(f)
+            # Entries of older caches do not record the order of the place
+            self.entries = OrderedDict(
+                (k, v) for k, v in entries.items() if len(v) == 3)
+            logging.info(f'Loaded {len(self.entries)} cached matches')
+            self._evict()
+
+    @staticmethod
+    def key(query_name, frame_ids, config_local):
+        # The predictor is a function, the remaining entries identify the
+        # local descriptors and the matching
+        descriptor_config = tuple(sorted(
+            (k, v) for k, v in config_local.items()
+            if k != 'ratio_thresh' and not callable(v)))
+        return (query_name, tuple(sorted(int(i) for i in frame_ids)),
+                config_local['ratio_thresh'], descriptor_config)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = str(self.path) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def reorder_place_matches(matches, frame_ids, new_frame_ids, local_db):
+    """Maps the place indices of matches against the landmarks of frame_ids
+       to the indices into the landmarks of the same frames in the order of
+       new_frame_ids.
+    """
+    offsets = {}
+    offset = 0
+    for frame_id in new_frame_ids:
+        offsets.setdefault(frame_id, []).append(offset)
+        offset += len(local_db[frame_id].landmark_ids)
+    mapping = np.concatenate(
+        [offsets[frame_id].pop(0)
+         + np.arange(len(local_db[frame_id].landmark_ids))
+         for frame_id in frame_ids])
+    return np.stack([matches[:, 0], mapping[matches[:, 1]]], -1).astype(
+        matches.dtype)
+
+
+def cached_match_against_place(cache, query_name, frame_ids, local_db,
+                               query_desc, config_local, debug_dict=None):
+    """`match_against_place` with the ratio threshold and matching method of
+       config_local, through the cache if it is not None. Cached entries
+       report the duration of the original matching. The cache is bypassed
+       when debugging.
+    """
+    if debug_dict is not None:
+        cache = None
+    key = None
+    if cache is not None:
+        key = MatchCache.key(query_name, frame_ids, config_local)
+        cached = cache.get(key)
+        if cached is not None:
+            # Landmarks are cheap to gather again, matches are not. The
+            # place may have been retrieved in a different order.
+            matches, cached_ids, duration = cached
+            place_lms = np.concatenate(
+                [local_db[frame_id].landmark_ids for frame_id in frame_ids])
+            if list(cached_ids) != list(frame_ids):
+                matches = reorder_place_matches(
+                    matches, cached_ids, frame_ids, local_db)
+            return matches, place_lms, duration
+
+    matches, place_lms, duration = match_against_place(
+        frame_ids, local_db, query_desc, config_local['ratio_thresh'],
+        do_fast_matching=config_local.get('fast_matching', True),
+        debug_dict=debug_dict)
+    if cache is not None:
+        cache.put(key, (matches, tuple(frame_ids), duration))
+    return matches, place_lms, duration
+
+
 def do_pnp(kpts, lms, query_info, config):
     kpts = kpts.astype(np.float32).reshape((-1, 1, 2))
     lms = lms.astype(np.float32).reshape((-1, 1, 3))
@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+import yaml
+import argparse
+import numpy as np
+from pathlib import Path
+from pprint import pformat
+
+logging.basicConfig(format='[%(asctime)s %(levelname)s] %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+from hfnet.models import get_model  # noqa: E402
+from hfnet.datasets import get_dataset  # noqa: E402
+from hfnet.utils import tools  # noqa: E402
+from hfnet.utils.stdout_capturing import capture_outputs  # noqa: E402
+from hfnet.settings import EXPER_PATH, DATA_PATH  # noqa: E402
+import tensorflow as tf  # noqa: E402
+from tensorflow.tools.graph_transforms import TransformGraph  # noqa: E402
+
+tf.contrib.resampler  # import C++ op
+
+# Outputs kept by each deployment profile, other heads are stripped
+PROFILES = {
+    'full': ['global_descriptor', 'keypoints', 'scores', 'local_descriptors'],
+    'global': ['global_descriptor'],
+    'local': ['keypoints', 'scores', 'local_descriptors'],
+}
+INPUTS = ['image']
+
+# The prediction graph is pinned to /gpu:0, the exports run on CPU-only hosts
+OPTIMIZE_TRANSFORMS = [
+    'remove_device',
+    'strip_unused_nodes(type=float)',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'merge_duplicate_nodes',
+    'strip_unused_nodes(type=float)',
+    'sort_by_execution_order',
+]
+QUANTIZE_TRANSFORMS = [
+    'quantize_weights',
+    'quantize_nodes',
+    'strip_unused_nodes(type=float)',
+    'sort_by_execution_order',
+]
+REQUANT_MESSAGE = '__requant_min_max:'
+
+
+def freeze(net, outputs):
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        net.sess, net.graph.as_graph_def(), outputs)
+    return TransformGraph(graph_def, INPUTS, outputs, OPTIMIZE_TRANSFORMS)
+
+
+def run_graph(graph_def, images, outputs):
+    # As on the target hosts, such that device pins fail here
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        fetches = [graph.get_tensor_by_name(n+':0') for n in outputs]
+        with tf.Session(graph=graph, config=config) as sess:
+            return [{n: v[0] for n, v in zip(
+                        outputs, sess.run(fetches, {'image:0': [im]}))}
+                    for im in images]
+
+
+def quantize(graph_def, outputs, calibration_images, log_path):
+    """Post-training 8-bit quantization, with the ranges of the activations
+       calibrated on images instead of being computed at runtime.
+    """
+    graph_def = TransformGraph(
+        graph_def, INPUTS, outputs, QUANTIZE_TRANSFORMS)
+    logging_def = TransformGraph(graph_def, INPUTS, outputs, [
+        'insert_logging(op=RequantizationRange, show_name=true, '
+        f'message="{REQUANT_MESSAGE}")'])
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    # The ranges are printed by the TensorFlow runtime
+    with capture_outputs(log_path):
+        run_graph(logging_def, calibration_images, outputs)
+    return TransformGraph(graph_def, INPUTS, outputs, [
+        f'freeze_requantization_ranges(min_max_log_file="{log_path}")',
+        'fold_constants(ignore_errors=true)',
+        'sort_by_execution_order'])
+
+
+def cosine(a, b):
+    a, b = np.float64(a), np.float64(b)
+    return np.sum(a*b, -1) / (np.linalg.norm(a, axis=-1)
+                              * np.linalg.norm(b, axis=-1) + 1e-12)
+
+
+def compare_predictions(reference, predictions, distance_thresh=3):
+    """Agreement of the predictions of a quantized graph with those of the
+       float graph: cosine similarity of the global descriptors, fraction of
+       reference keypoints that are detected within `distance_thresh` pixels,
+       and cosine similarity of the local descriptors of these keypoints.
+    """
+    metrics = {'global_cosine': [], 'keypoint_recall': [],
+               'local_cosine': []}
+    for ref, pred in zip(reference, predictions):
+        if 'global_descriptor' in ref:
+            metrics['global_cosine'].append(cosine(
+                ref['global_descriptor'], pred['global_descriptor']))
+        if 'keypoints' in ref and len(ref['keypoints']):
+            if len(pred['keypoints']) == 0:
+                metrics['keypoint_recall'].append(0.)
+                continue
+            dist = np.linalg.norm(
+                ref['keypoints'][:, None] - pred['keypoints'][None], axis=-1)
+            nearest = np.argmin(dist, axis=1)
+            found = dist[np.arange(len(nearest)), nearest] <= distance_thresh
+            metrics['keypoint_recall'].append(np.mean(found))
+            if np.any(found):
+                metrics['local_cosine'].append(np.mean(cosine(
+                    ref['local_descriptors'][found],
+                    pred['local_descriptors'][nearest[found]])))
+    return {k: float(np.mean(v)) for k, v in metrics.items() if len(v)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', type=str)
+    parser.add_argument('export_name', type=str)
+    parser.add_argument('--exper_name', type=str)
+    parser.add_argument('--profiles', type=str, nargs='+', default=['full'],
+                        choices=list(PROFILES))
+    parser.add_argument('--int8', action='store_true')
+    parser.add_argument('--num_calibration', type=int, default=50)
+    parser.add_argument('--num_validation', type=int, default=50)
+    parser.add_argument('--min_keypoint_recall', type=float, default=0.9)
+    args = parser.parse_args()
+
+    export_name = args.export_name
+    exper_name = args.exper_name
+
+    with open(args.config, 'r') as f:
+        config = yaml.load(f)
+
+    export_dir = Path(EXPER_PATH, 'saved_models', export_name)
+    export_dir.mkdir(parents=True, exist_ok=True)
+
+    if exper_name:
+        assert Path(EXPER_PATH, exper_name).exists()
+        with open(Path(EXPER_PATH, exper_name, 'config.yml'), 'r') as f:
+            config['model'] = tools.dict_update(
+                yaml.load(f)['model'], config.get('model', {}))
+        checkpoint_path = Path(EXPER_PATH, exper_name)
+        if config.get('weights', None):
+            checkpoint_path = Path(checkpoint_path, config['weights'])
+    else:
+        checkpoint_path = Path(DATA_PATH, 'weights', config['weights'])
+    logging.info(f'Exporting model with configuration:\n{pformat(config)}')
+
+    with get_model(config['model']['name'])(
+            data_shape={'image': [None, None, None,
+                                  config['model']['image_channels']]},
+            **config['model']) as net:
+        net.load(str(checkpoint_path))
+        frozen = {}
+        for profile in args.profiles:
+            outputs = [o for o in PROFILES[profile] if o in net.pred_out]
+            if not outputs:
+                logging.info(f'Model has no outputs for profile {profile}.')
+                continue
+            frozen[profile] = (freeze(net, outputs), outputs)
+
+    images = []
+    if args.int8:
+        assert 'data' in config, 'Calibration requires a dataset config.'
+        dataset = get_dataset(config['data']['name'])(**config['data'])
+        for data in dataset.get_test_set():
+            if len(images) == args.num_calibration + args.num_validation:
+                break
+            images.append(data['image'])
+    calibration_images = images[:args.num_calibration]
+    validation_images = images[args.num_calibration:]
+
+    dummy_image = np.zeros(
+        (240, 320, config['model']['image_channels']), np.float32)
+    for profile, (graph_def, outputs) in frozen.items():
+        path = Path(export_dir, f'{profile}.pb')
+        tf.train.write_graph(graph_def, str(export_dir), path.name,
+                             as_text=False)
+        run_graph(graph_def, [dummy_image], outputs)  # runs without GPU
+        logging.info(f'Wrote {path} with outputs {outputs}.')
+        if not args.int8:
+            continue
+
+        quantized = quantize(
+            graph_def, outputs, calibration_images,
+            str(Path(export_dir, f'{profile}_int8_ranges.log')))
+        path = Path(export_dir, f'{profile}_int8.pb')
+        tf.train.write_graph(quantized, str(export_dir), path.name,
+                             as_text=False)
+        metrics = compare_predictions(
+            run_graph(graph_def, validation_images, outputs),
+            run_graph(quantized, validation_images, outputs))
+        with open(Path(export_dir, f'{profile}_int8_validation.json'),
+                  'w') as f:
+            json.dump(metrics, f, indent=2)
+        logging.info(f'Wrote {path}, agreement with the float model on '
+                     f'{len(validation_images)} images: {metrics}')
+        if metrics.get('keypoint_recall', 1.) < args.min_keypoint_recall:
+            logging.warning(f'The int8 graph of profile {profile} recovers '
+                            'too few keypoints of the float graph.')
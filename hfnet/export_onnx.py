@@ -0,0 +1,117 @@
+import logging
+import yaml
+import argparse
+import numpy as np
+from pathlib import Path
+from pprint import pformat
+
+logging.basicConfig(format='[%(asctime)s %(levelname)s] %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+from hfnet.models import get_model  # noqa: E402
+from hfnet.models.onnx_model import OnnxModel  # noqa: E402
+from hfnet.datasets import get_dataset  # noqa: E402
+from hfnet.utils import tools  # noqa: E402
+from hfnet.settings import EXPER_PATH, DATA_PATH  # noqa: E402
+import tensorflow as tf  # noqa: E402
+
+# Dense outputs exported to ONNX, the rest is computed by `OnnxModel`
+DENSE_OUTPUTS = ['scores_dense', 'local_descriptor_map', 'global_descriptor']
+
+
+def keypoint_config(config):
+    local = config['local'] if 'local' in config else config
+    return {'detector_threshold': local['detector_threshold'],
+            'nms_radius': local['nms_radius'],
+            'num_keypoints': local['num_keypoints']}
+
+
+def to_onnx(graph_def, outputs, name, opset):
+    import tf2onnx
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        onnx_graph = tf2onnx.tfonnx.process_tf_graph(
+            graph, opset=opset, input_names=['image:0'],
+            output_names=[o+':0' for o in outputs])
+    onnx_graph = tf2onnx.optimizer.optimize_graph(onnx_graph)
+    return onnx_graph.make_model(name)
+
+
+def compare(net, onnx_model, images):
+    """Largest deviation of the ONNX predictions from those of TensorFlow.
+    """
+    diffs = {}
+    for image in images:
+        ref = net.predict({'image': image})
+        pred = onnx_model.predict({'image': image})
+        for k in ['keypoints', 'scores', 'local_descriptors',
+                  'global_descriptor']:
+            if k not in ref:
+                continue
+            if ref[k].shape != pred[k].shape:
+                diffs[k] = np.inf
+                continue
+            d = np.max(np.abs(ref[k] - pred[k]), initial=0)
+            diffs[k] = max(diffs.get(k, 0), float(d))
+    return diffs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', type=str)
+    parser.add_argument('export_name', type=str)
+    parser.add_argument('--exper_name', type=str)
+    parser.add_argument('--opset', type=int, default=11)
+    parser.add_argument('--num_validation', type=int, default=0,
+                        help='compare with TensorFlow on dataset images')
+    args = parser.parse_args()
+
+    export_name = args.export_name
+    exper_name = args.exper_name
+
+    with open(args.config, 'r') as f:
+        config = yaml.load(f)
+
+    export_dir = Path(EXPER_PATH, 'onnx_models')
+    export_dir.mkdir(parents=True, exist_ok=True)
+    export_path = Path(export_dir, f'{export_name}.onnx')
+
+    if exper_name:
+        assert Path(EXPER_PATH, exper_name).exists()
+        with open(Path(EXPER_PATH, exper_name, 'config.yml'), 'r') as f:
+            config['model'] = tools.dict_update(
+                yaml.load(f)['model'], config.get('model', {}))
+        checkpoint_path = Path(EXPER_PATH, exper_name)
+        if config.get('weights', None):
+            checkpoint_path = Path(checkpoint_path, config['weights'])
+    else:
+        checkpoint_path = Path(DATA_PATH, 'weights', config['weights'])
+    logging.info(f'Exporting model with configuration:\n{pformat(config)}')
+
+    with get_model(config['model']['name'])(
+            data_shape={'image': [None, None, None,
+                                  config['model']['image_channels']]},
+            **config['model']) as net:
+        net.load(str(checkpoint_path))
+
+        outputs = [o for o in DENSE_OUTPUTS if o in net.pred_out]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            net.sess, net.graph.as_graph_def(), outputs)
+        model = to_onnx(graph_def, outputs, export_name, args.opset)
+        with open(export_path, 'wb') as f:
+            f.write(model.SerializeToString())
+
+        onnx_config = {'model': config['model']['name'], 'outputs': outputs}
+        if 'scores_dense' in outputs:
+            onnx_config['keypoints'] = keypoint_config(net.config)
+        with open(export_path.with_suffix('.yaml'), 'w') as f:
+            yaml.dump(onnx_config, f, default_flow_style=False)
+        logging.info(f'Wrote {export_path} with outputs {outputs}.')
+
+        if args.num_validation:
+            dataset = get_dataset(config['data']['name'])(**config['data'])
+            images = [data['image'] for _, data in zip(
+                range(args.num_validation), dataset.get_test_set())]
+            diffs = compare(net, OnnxModel(export_path), images)
+            logging.info('Maximum deviation from TensorFlow on '
+                         f'{len(images)} images: {diffs}')
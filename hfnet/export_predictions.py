@@ -1,3 +1,4 @@
+import sys
 import numpy as np
 import argparse
 import yaml
@@ -12,8 +13,95 @@ logging.basicConfig(format='[%(asctime)s %(levelname)s] %(message)s',
 from hfnet.models import get_model  # noqa: E402
 from hfnet.datasets import get_dataset  # noqa: E402
 from hfnet.utils import tools  # noqa: E402
+from hfnet.utils.writer import NpzWriter  # noqa: E402
+from hfnet.utils.export_store import ExportStore  # noqa: E402
+from hfnet.utils.sharding import (  # noqa: E402
+    parse_shard, shard_of, write_manifest, check_manifests)
 from hfnet.settings import EXPER_PATH, DATA_PATH  # noqa: E402
 
+# Outputs with a different number of entries per image
+RAGGED_KEYS = ['keypoints', 'scores', 'local_descriptors']
+# Outputs that can be stored in half precision
+DESCRIPTOR_KEYS = ['local_descriptor_map', 'local_descriptors',
+                   'global_descriptor']
+
+
+def compress(predictions, float16=False, sparse=False):
+    """Reduces the size of the exported descriptors. With `sparse`, the
+       dense descriptor map is dropped if the descriptors of the keypoints
+       are exported. Readers upcast half precision descriptors when used.
+    """
+    if sparse and 'local_descriptors' in predictions:
+        predictions.pop('local_descriptor_map', None)
+    if float16:
+        for k in DESCRIPTOR_KEYS:
+            if k in predictions:
+                predictions[k] = predictions[k].astype(np.float16)
+    return predictions
+
+
+def size_buckets(data_iter, batch_size):
+    """Groups the images of a dataset into batches of equal image size.
+       Incomplete batches are yielded once the dataset is exhausted.
+    """
+    buckets = {}
+    for data in data_iter:
+        bucket = buckets.setdefault(data['image'].shape, [])
+        bucket.append(data)
+        if len(bucket) == batch_size:
+            yield buckets.pop(data['image'].shape)
+    yield from buckets.values()
+
+
+def select_images(data_iter, shard, num_shards, skip, names):
+    """Keeps the images of a shard and records their names in `names`.
+       Images for which `skip` returns True are not processed again.
+    """
+    for data in data_iter:
+        name = data['name'].decode('utf-8')
+        if shard_of(name, num_shards) != shard:
+            continue
+        names.append(name)
+        if skip(name):
+            continue
+        yield data
+
+
+def verify(base_dir, num_shards, export_format):
+    if export_format == 'pack':
+        with ExportStore(base_dir) as store:
+            report = check_manifests(
+                base_dir, num_shards, lambda n: n in store)
+    else:
+        report = check_manifests(
+            base_dir, num_shards,
+            lambda n: Path(base_dir, f'{n}.npz').exists())
+    for k in ['missing_shards', 'duplicates', 'missing_images']:
+        if report[k]:
+            logging.error(f'{len(report[k])} {k}: {report[k][:10]}')
+    complete = not any(report[k] for k in
+                       ['missing_shards', 'duplicates', 'missing_images'])
+    logging.info(f'Export of {report["num_images"]} images in {num_shards} '
+                 f'shards is {"" if complete else "NOT "}complete.')
+    return complete
+
+
+def predict_batch(net, batch, keys):
+    """Runs the network on a batch of images and splits its outputs into the
+       predictions of each image, identical to those of an unbatched run.
+    """
+    if keys != '*':
+        keys = keys + ['num_keypoints']*('num_keypoints' in net.pred_out)
+    pred = net.predict(
+        {'image': np.stack([data['image'] for data in batch])},
+        keys=keys, batch=True)
+    counts = pred.pop('num_keypoints', None)
+    if counts is None and any(k in pred for k in RAGGED_KEYS):
+        raise ValueError('Batched keypoint extraction is not supported '
+                         'by this model, use --batch_size 1.')
+    return [{k: v[i][:counts[i]] if k in RAGGED_KEYS else v[i]
+             for k, v in pred.items()} for i in range(len(batch))]
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -22,6 +110,21 @@ if __name__ == '__main__':
     parser.add_argument('--keys', type=str, default='*')
     parser.add_argument('--exper_name', type=str)
     parser.add_argument('--as_dataset', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_writers', type=int, default=2)
+    parser.add_argument('--format', type=str, default='npz',
+                        choices=['npz', 'pack'])
+    parser.add_argument('--fsync', type=str, default='none',
+                        choices=sorted(NpzWriter.fsync_policies))
+    parser.add_argument('--float16', action='store_true',
+                        help='store the descriptors in half precision')
+    parser.add_argument('--sparse_descriptors', action='store_true',
+                        help='store only the descriptors of the keypoints')
+    parser.add_argument('--shard', type=str, help='i/N, process only the '
+                        'i-th of N partitions of the dataset')
+    parser.add_argument('--skip_existing', action='store_true')
+    parser.add_argument('--verify', type=int, metavar='NUM_SHARDS',
+                        help='check the manifests of a sharded export')
     args = parser.parse_args()
 
     export_name = args.export_name
@@ -34,8 +137,12 @@ if __name__ == '__main__':
         base_dir = Path(DATA_PATH, export_name)
     else:
         base_dir = Path(EXPER_PATH, 'exports')
-        base_dir = Path(base_dir, ((exper_name+'/') if exper_name else '') + export_name)
+        base_dir = Path(
+            base_dir, ((exper_name+'/') if exper_name else '') + export_name)
     base_dir.mkdir(parents=True, exist_ok=True)
+    if args.verify:
+        sys.exit(0 if verify(base_dir, args.verify, args.format) else 1)
+    shard, num_shards = parse_shard(args.shard)
 
     if exper_name:
         # Update only the model config (not the dataset)
@@ -51,19 +158,43 @@ if __name__ == '__main__':
         else:
             checkpoint_path = None
             logging.info('No weights provided.')
+    if args.batch_size > 1:
+        config['model']['batched_extraction'] = True
     logging.info(f'Starting export with configuration:\n{pformat(config)}')
 
     with get_model(config['model']['name'])(
-            data_shape={'image': [None, None, None, config['model']['image_channels']]},
+            data_shape={'image': [None, None, None,
+                                  config['model']['image_channels']]},
             **config['model']) as net:
         if checkpoint_path is not None:
             net.load(str(checkpoint_path))
         dataset = get_dataset(config['data']['name'])(**config['data'])
         test_set = dataset.get_test_set()
 
-        for data in tqdm(test_set):
-            predictions = net.predict(data, keys=keys)
-            predictions['input_shape'] = data['image'].shape
-            name = data['name'].decode('utf-8')
-            Path(base_dir, Path(name).parent).mkdir(parents=True, exist_ok=True)
-            np.savez(Path(base_dir, '{}.npz'.format(name)), **predictions)
+        # Each shard appends to its own part of the container
+        part = f'{shard}-of-{num_shards}' if num_shards > 1 else None
+        names = []
+        with NpzWriter(base_dir, container=(args.format == 'pack'),
+                       part=part, num_workers=args.num_writers,
+                       fsync=args.fsync) as writer:
+            skip = writer.exists if args.skip_existing else lambda n: False
+            test_set = select_images(
+                tqdm(test_set), shard, num_shards, skip, names)
+            if args.batch_size > 1:
+                batches = size_buckets(test_set, args.batch_size)
+                results = ((data, pred) for batch in batches
+                           for data, pred in zip(
+                               batch, predict_batch(net, batch, keys)))
+            else:
+                results = ((data, net.predict(data, keys=keys))
+                           for data in test_set)
+
+            for data, predictions in results:
+                predictions['input_shape'] = data['image'].shape
+                predictions = compress(
+                    predictions, args.float16, args.sparse_descriptors)
+                writer.write(data['name'].decode('utf-8'), predictions)
+        if args.shard:
+            write_manifest(base_dir, shard, num_shards, names)
+            logging.info(f'Exported shard {shard}/{num_shards} '
+                         f'with {len(names)} images.')
@@ -4,7 +4,8 @@ from tensorflow.contrib import slim
 from .base_model import BaseModel, Mode
 from .backbones import mobilenet_v2 as mobilenet
 from .utils.layers import (vlad, dimensionality_reduction,
-                           image_normalization, simple_nms)
+                           image_normalization, simple_nms,
+                           batched_keypoint_extraction)
 
 from .backbones.utils import conv_blocks as ops
 from .backbones.utils import mobilenet as lib
@@ -176,60 +177,97 @@ class HfNet(BaseModel):
             },
             'train_backbone': True,
             'train_vlad': True,
+            'batched_extraction': False,
+            # Prediction only: heads to build, and scale of the image
+            # given to the global head, e.g. 0.5 for retrieval at half size
+            'heads': ['local', 'global'],
+            'global_scale': 1.,
     }
 
     def _model(self, inputs, mode, **config):
         image = image_normalization(inputs['image'])
         training = (mode == Mode.TRAIN)
+        # The losses and metrics require both heads at full resolution
+        if mode == Mode.PRED:
+            heads, global_scale = config['heads'], config['global_scale']
+        else:
+            heads, global_scale = ['local', 'global'], 1.
+        assert len(heads) and set(heads) <= {'local', 'global'}, heads
 
         size = tf.shape(image)[1:3]
         target_size = tf.to_int64(tf.floor(tf.to_float(size)/8)*8)
         image = image[:, :target_size[0], :target_size[1]]
 
-        with slim.arg_scope(mobilenet.training_scope(
-                is_training=training & config['train_backbone'],
-                dropout_keep_prob=config['dropout_keep_prob'])):
-            _, encoder = mobilenet.mobilenet(
-                    image, num_classes=None, base_only=True,
-                    depth_multiplier=config['depth_multiplier'],
-                    final_endpoint=config['global_endpoint'],
-                    conv_defs=MOBILENET_DEF)
-
-        with tf.variable_scope('local_head', reuse=tf.AUTO_REUSE), \
-                slim.arg_scope(mobilenet.training_scope(
-                    is_training=training,
+        def backbone(image, final_endpoint):
+            with slim.arg_scope(mobilenet.training_scope(
+                    is_training=training & config['train_backbone'],
                     dropout_keep_prob=config['dropout_keep_prob'])):
-            local_feat = encoder[config['local_endpoint']]
-            ret_local = local_head(local_feat, config['local'])
+                _, encoder = mobilenet.mobilenet(
+                        image, num_classes=None, base_only=True,
+                        depth_multiplier=config['depth_multiplier'],
+                        final_endpoint=final_endpoint,
+                        conv_defs=MOBILENET_DEF)
+            return encoder
 
-        with tf.variable_scope('global_head', reuse=tf.AUTO_REUSE):
-            global_feat = encoder[config['global_endpoint']]
-            mask = inputs.get('valid_mask', None)
-            if mask is not None:
-                mask = tf.image.resize_nearest_neighbor(
-                    tf.to_float(mask)[..., tf.newaxis],
-                    tf.shape(global_feat)[1:3])[..., 0]
-            ret_global = global_head(
-                global_feat, training, config['global'], mask=mask)
+        # Both heads share the backbone only if they have the same input,
+        # otherwise the local head stops at its earlier endpoint.
+        shared = len(heads) == 2 and global_scale == 1.
+        ret = {}
+        if 'local' in heads:
+            encoder = backbone(image, config['global_endpoint'] if shared
+                               else config['local_endpoint'])
+            with tf.variable_scope('local_head', reuse=tf.AUTO_REUSE), \
+                    slim.arg_scope(mobilenet.training_scope(
+                        is_training=training,
+                        dropout_keep_prob=config['dropout_keep_prob'])):
+                local_feat = encoder[config['local_endpoint']]
+                ret = {**ret, **local_head(local_feat, config['local'])}
 
-        ret = {**ret_local, **ret_global}
-        if mode == Mode.PRED:
-            # Batch size 1 required
+        if 'global' in heads:
+            if not shared:
+                global_image = image
+                if global_scale != 1.:
+                    global_size = tf.to_int32(tf.round(
+                        tf.to_float(tf.shape(image)[1:3]) * global_scale))
+                    global_image = tf.image.resize_images(
+                        image, global_size,
+                        method=tf.image.ResizeMethod.AREA)
+                encoder = backbone(global_image, config['global_endpoint'])
+            with tf.variable_scope('global_head', reuse=tf.AUTO_REUSE):
+                global_feat = encoder[config['global_endpoint']]
+                mask = inputs.get('valid_mask', None)
+                if mask is not None:
+                    mask = tf.image.resize_nearest_neighbor(
+                        tf.to_float(mask)[..., tf.newaxis],
+                        tf.shape(global_feat)[1:3])[..., 0]
+                ret = {**ret, **global_head(
+                    global_feat, training, config['global'], mask=mask)}
+
+        if mode == Mode.PRED and 'local' in heads:
             scores = ret['scores_dense']
             if config['local']['nms_radius']:
                 scores = simple_nms(scores, config['local']['nms_radius'])
-            with tf.name_scope('keypoint_extraction'):
-                keypoints = tf.where(tf.greater_equal(
-                    scores[0], config['local']['detector_threshold']))
-                scores = tf.gather_nd(scores[0], keypoints)
-            if config['local']['num_keypoints']:
-                with tf.name_scope('top_k_keypoints'):
-                    k = tf.constant(config['local']['num_keypoints'], name='k')
-                    k = tf.minimum(tf.shape(scores)[0], k)
-                    scores, indices = tf.nn.top_k(scores, k)
-                    keypoints = tf.to_int32(tf.gather(
-                        tf.to_float(keypoints), indices))
-            keypoints, scores = keypoints[None], scores[None]
+            if config['batched_extraction']:
+                # Ragged outputs are padded, see `num_keypoints`
+                keypoints, scores, counts = batched_keypoint_extraction(
+                    scores, config['local']['detector_threshold'],
+                    config['local']['num_keypoints'])
+                ret['num_keypoints'] = counts
+            else:
+                # Batch size 1 required
+                with tf.name_scope('keypoint_extraction'):
+                    keypoints = tf.where(tf.greater_equal(
+                        scores[0], config['local']['detector_threshold']))
+                    scores = tf.gather_nd(scores[0], keypoints)
+                if config['local']['num_keypoints']:
+                    with tf.name_scope('top_k_keypoints'):
+                        k = tf.constant(
+                            config['local']['num_keypoints'], name='k')
+                        k = tf.minimum(tf.shape(scores)[0], k)
+                        scores, indices = tf.nn.top_k(scores, k)
+                        keypoints = tf.to_int32(tf.gather(
+                            tf.to_float(keypoints), indices))
+                keypoints, scores = keypoints[None], scores[None]
             keypoints = keypoints[..., ::-1]  # x-y convention
             with tf.name_scope('descriptor_sampling'):
                 desc = ret['local_descriptor_map']
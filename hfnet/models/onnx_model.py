@@ -0,0 +1,116 @@
+"""Inference of exported ONNX models with onnxruntime, without TensorFlow.
+
+The ONNX graphs only contain the dense outputs of the networks. Keypoint
+extraction and descriptor sampling, which rely on TensorFlow ops without ONNX
+equivalent, are reproduced here on the host with the same results.
+"""
+import numpy as np
+import yaml
+from pathlib import Path
+from scipy.ndimage import maximum_filter
+
+
+def max_pool(x, size):
+    # Same as a SAME max-pooling with stride 1, which ignores the padding
+    return maximum_filter(x, size=size, mode='constant', cval=-np.inf)
+
+
+def simple_nms(scores, radius, iterations=3):
+    """Host counterpart of `hfnet.models.utils.layers.simple_nms` for a single
+       heatmap with shape `[H, W]`.
+    """
+    size = radius*2 + 1
+    zeros = np.zeros_like(scores)
+    max_mask = scores == max_pool(scores, size)
+    for _ in range(iterations-1):
+        supp_mask = max_pool(max_mask.astype(np.float32), size) > 0
+        supp_scores = np.where(supp_mask, zeros, scores)
+        new_max_mask = supp_scores == max_pool(supp_scores, size)
+        max_mask = max_mask | (new_max_mask & np.logical_not(supp_mask))
+    return np.where(max_mask, scores, zeros)
+
+
+def extract_keypoints(scores, threshold, num_keypoints=0):
+    """Thresholding and top-k selection of the keypoints of a heatmap, in the
+       order of `tf.where` and `tf.nn.top_k`. Returns `(x, y)` coordinates.
+    """
+    keypoints = np.stack(np.where(scores >= threshold), -1)
+    scores = scores[tuple(keypoints.T)]
+    if num_keypoints:
+        # top_k puts the lowest index first among equal scores
+        indices = np.argsort(-scores, kind='stable')[:num_keypoints]
+        keypoints, scores = keypoints[indices].astype(np.int32), scores[indices]
+    return keypoints[:, ::-1], scores
+
+
+def resample(data, warp):
+    """Bilinear interpolation of `data` with shape `[H, W, C]` at the `(x, y)`
+       points `warp`, with zeros outside of the map, as
+       `tf.contrib.resampler.resampler`.
+    """
+    h, w = data.shape[:2]
+    padded = np.zeros((h+1, w+1, data.shape[-1]), data.dtype)
+    padded[:h, :w] = data
+    x, y = warp[:, 0], warp[:, 1]
+    x0, y0 = np.floor(x), np.floor(y)
+    dx, dy = (x - x0)[:, None], (y - y0)[:, None]
+    x0, y0 = x0.astype(int), y0.astype(int)
+    x1, y1 = x0 + 1, y0 + 1
+    return ((1-dx)*(1-dy)*padded[y0, x0] + dx*(1-dy)*padded[y0, x1]
+            + (1-dx)*dy*padded[y1, x0] + dx*dy*padded[y1, x1])
+
+
+def l2_normalize(x, epsilon=1e-12):
+    return x / np.sqrt(np.maximum(
+        np.sum(np.square(x), -1, keepdims=True), epsilon))
+
+
+class OnnxModel(object):
+    """Runs an ONNX model exported by `hfnet/export_onnx.py` and returns the
+       same predictions as `BaseModel.predict` for a single image.
+
+    Arguments:
+        path: The path of the `.onnx` file, next to its `.yaml` configuration.
+        num_threads: The number of threads of onnxruntime, 0 for its default.
+    """
+    def __init__(self, path, num_threads=0):
+        import onnxruntime
+        with open(Path(path).with_suffix('.yaml'), 'r') as f:
+            self.config = yaml.safe_load(f)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            str(path), options, providers=['CPUExecutionProvider'])
+        self.outputs = {o.name.split(':')[0]: o.name
+                        for o in self.session.get_outputs()}
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _postprocess(self, dense, image_shape):
+        config = self.config['keypoints']
+        scores = dense['scores_dense']
+        if config['nms_radius']:
+            scores = simple_nms(scores, config['nms_radius'])
+        keypoints, scores = extract_keypoints(
+            scores, config['detector_threshold'], config['num_keypoints'])
+
+        # The network crops the image to a multiple of 8
+        desc = dense['local_descriptor_map']
+        image_shape = np.array(image_shape[:2]) // 8 * 8
+        scaling = ((np.array(desc.shape[:2], np.float64) - 1.)
+                   / (image_shape - 1.)).astype(np.float32)
+        local_descriptors = l2_normalize(resample(
+            desc, scaling[::-1] * keypoints.astype(np.float32)))
+        return {'keypoints': keypoints, 'scores': scores,
+                'local_descriptors': local_descriptors}
+
+    def predict(self, data, keys='*'):
+        image = np.asarray(data['image'], np.float32)
+        dense = self.session.run(
+            list(self.outputs.values()), {self.input_name: image[None]})
+        pred = {n: v[0] for n, v in zip(self.outputs, dense)}
+        if 'scores_dense' in pred:
+            pred.update(self._postprocess(pred, image.shape))
+
+        if isinstance(keys, str):
+            return pred if keys == '*' else pred[keys]
+        return {k: pred[k] for k in keys}
@@ -66,7 +66,7 @@ def detector_head(inputs, **config):
                 data_format='NCHW' if cfirst else 'NHWC')
         prob = tf.squeeze(prob, axis=cindex)
 
-    return {'logits': x, 'scores': prob}
+    return {'logits': x, 'scores_dense': prob}
 
 
 def descriptor_head(inputs, **config):
@@ -121,15 +121,15 @@ class SuperPoint(BaseModel):
         if mode == Mode.PRED:
             # Batch size 1 required
             scores = results['scores_dense']
-            if config['local']['nms']:
-                scores = simple_nms(scores, config['local']['nms'])
+            if config['nms_radius']:
+                scores = simple_nms(scores, config['nms_radius'])
             with tf.name_scope('keypoint_extraction'):
                 keypoints = tf.where(tf.greater_equal(
-                    scores[0], config['local']['detector_threshold']))
+                    scores[0], config['detector_threshold']))
                 scores = tf.gather_nd(scores[0], keypoints)
-            if config['local']['num_keypoints']:
+            if config['num_keypoints']:
                 with tf.name_scope('top_k_keypoints'):
-                    k = tf.constant(config['local']['num_keypoints'], name='k')
+                    k = tf.constant(config['num_keypoints'], name='k')
                     k = tf.minimum(tf.shape(scores)[0], k)
                     scores, indices = tf.nn.top_k(scores, k)
                     keypoints = tf.to_int32(tf.gather(
@@ -32,6 +32,57 @@ def simple_nms(scores, radius, iterations=3):
         return tf.where(max_mask, scores, zeros)
 
 
+def batched_keypoint_extraction(scores, threshold, num_keypoints=0):
+    """Extracts the keypoints of a batch of score heatmaps.
+    The keypoints of each image are identical to those obtained by applying
+    `tf.where` and `tf.nn.top_k` to its heatmap alone. As images have different
+    numbers of keypoints, the outputs are padded to the largest count.
+    Arguments:
+        scores: the score heatmap, with shape `[B, H, W]`.
+        threshold: the minimum score of a keypoint.
+        num_keypoints: the maximum number of keypoints per image, or 0 to keep
+            all of them.
+    Returns:
+        keypoints: the `(y, x)` keypoint coordinates, with shape `[B, N, 2]`,
+            padded with zeros.
+        scores: the keypoint scores, with shape `[B, N]`, padded with -1.
+        counts: the number of valid keypoints of each image, with shape `[B]`.
+    """
+    with tf.name_scope('batched_keypoint_extraction'):
+        batch_size = tf.shape(scores)[0]
+        # Sorted by image, then in row-major order as for a single image
+        indices = tf.where(tf.greater_equal(scores, threshold))
+        values = tf.gather_nd(scores, indices)
+        image_ids = tf.to_int32(indices[:, 0])
+        counts = tf.unsorted_segment_sum(
+            tf.ones_like(image_ids), image_ids, batch_size)
+
+        # Rank of each keypoint within its image
+        offsets = tf.cumsum(counts, exclusive=True)
+        ranks = tf.range(tf.shape(indices)[0]) - tf.gather(offsets, image_ids)
+        padded_shape = tf.stack([batch_size, tf.reduce_max(counts)])
+        scatter_indices = tf.stack([image_ids, ranks], -1)
+        keypoints = tf.scatter_nd(
+            scatter_indices, indices[:, 1:], tf.concat([padded_shape, [2]], 0))
+        valid = tf.sequence_mask(counts, padded_shape[1])
+        scores = tf.where(
+            valid, tf.scatter_nd(scatter_indices, values, padded_shape),
+            -tf.ones(padded_shape, dtype=scores.dtype))
+
+        if num_keypoints:
+            with tf.name_scope('top_k_keypoints'):
+                k = tf.constant(num_keypoints, name='k')
+                k = tf.minimum(padded_shape[1], k)
+                # Padding scores are lower than any valid score
+                scores, top_indices = tf.nn.top_k(scores, k)
+                batch_indices = tf.tile(tf.range(batch_size)[:, None], [1, k])
+                keypoints = tf.to_int32(tf.gather_nd(
+                    tf.to_float(keypoints),
+                    tf.stack([batch_indices, top_indices], -1)))
+                counts = tf.minimum(counts, k)
+        return keypoints, scores, counts
+
+
 def delf_attention(feature_map, config, is_training, arg_scope=None):
     with tf.variable_scope('attonly/attention/compute'):
         with slim.arg_scope(arg_scope):
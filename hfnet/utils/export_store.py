@@ -0,0 +1,126 @@
+import io
+import os
+import threading
+import numpy as np
+from pathlib import Path
+
+
+def serialize(data):
+    """Returns the content of the `.npz` file of a dictionary of arrays.
+    """
+    buf = io.BytesIO()
+    np.savez(buf, **data)
+    return buf.getvalue()
+
+
+class ExportStore(object):
+    """Single-file container of exported predictions, as an alternative to one
+       `.npz` file per image. Each entry is a `.npz` blob appended to
+       `predictions.pack`, after which its name, offset and size are appended
+       to `predictions.index`. An interrupted export thus leaves a readable
+       store, and entries written again shadow the previous ones.
+       Concurrent exports, e.g. of the shards of a dataset, each append to
+       their own part, `predictions.<part>.[pack|index]`, and all parts are
+       read as a single store.
+
+    Arguments:
+        base_dir: The directory of the store.
+        mode: `'r'` to read an existing store, `'a'` to create or append to it.
+        part: The name of the part to append to, if any.
+    """
+    prefix = 'predictions'
+
+    def __init__(self, base_dir, mode='r', part=None):
+        assert mode in ['r', 'a'], f'Unknown mode {mode}'
+        self.base_dir = Path(base_dir)
+        self.mode = mode
+        if mode == 'a':
+            name = self.prefix + ('' if part is None else f'.{part}')
+            self.base_dir.mkdir(parents=True, exist_ok=True)
+            self.lock = threading.Lock()
+            self.data_out = open(Path(base_dir, name+'.pack'), 'ab')
+            own_index = Path(base_dir, name+'.index')
+            own_index.touch()
+
+        self.index = {}
+        self.fds = []
+        for i, index_path in enumerate(self.index_paths(base_dir)):
+            data_path = index_path.with_suffix('.pack')
+            self.fds.append(os.open(data_path, os.O_RDONLY))
+            truncate = mode == 'a' and index_path == own_index
+            for name, entry in self._read_index(index_path, truncate):
+                self.index[name] = (i,) + entry
+            if truncate:
+                self.part_id = i
+        if mode == 'r' and not self.fds:
+            raise FileNotFoundError(f'No export store in {base_dir}')
+        if mode == 'a':
+            self.index_out = open(own_index, 'a')
+
+    @classmethod
+    def index_paths(cls, base_dir):
+        return sorted(Path(base_dir).glob(cls.prefix+'*.index'))
+
+    @classmethod
+    def exists(cls, base_dir):
+        return len(cls.index_paths(base_dir)) > 0
+
+    def _read_index(self, index_path, truncate):
+        with open(index_path, 'r') as f:
+            lines = f.read().split('\n')
+        # The last line is empty unless its write was interrupted
+        if lines[-1] and truncate:
+            size = os.path.getsize(index_path) - len(lines[-1].encode())
+            os.truncate(index_path, size)
+        for line in lines[:-1]:
+            name, offset, size = line.rsplit('\t', 2)
+            yield name, (int(offset), int(size))
+
+    def append(self, name, blob):
+        """Appends the serialized predictions `blob` of an image.
+        """
+        with self.lock:
+            offset = self.data_out.seek(0, os.SEEK_END)
+            self.data_out.write(blob)
+            self.data_out.flush()
+            self.index_out.write(f'{name}\t{offset}\t{len(blob)}\n')
+            self.index_out.flush()
+            self.index[name] = (self.part_id, offset, len(blob))
+
+    def write(self, name, data):
+        self.append(name, serialize(data))
+
+    def read(self, name):
+        """Returns the dictionary of predictions of an image.
+        """
+        part_id, offset, size = self.index[name]
+        buf = os.pread(self.fds[part_id], size, offset)
+        with np.load(io.BytesIO(buf)) as p:
+            return {k: v for k, v in p.items()}
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.data_out.fileno())
+            os.fsync(self.index_out.fileno())
+
+    def names(self):
+        return list(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self.mode == 'a':
+            self.data_out.close()
+            self.index_out.close()
+        for fd in self.fds:
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,71 @@
+import os
+import json
+import zlib
+from pathlib import Path
+
+
+def parse_shard(shard):
+    """Parses a shard specification `i/N` into the pair `(i, N)`.
+    """
+    if shard is None:
+        return 0, 1
+    i, n = (int(s) for s in shard.split('/'))
+    if not 0 <= i < n:
+        raise ValueError(
+            f'Invalid shard {shard}, expected i/N with 0 <= i < N')
+    return i, n
+
+
+def shard_of(name, num_shards):
+    """Shard of an image, stable across runs, machines and dataset orderings.
+    """
+    return zlib.crc32(name.encode('utf-8')) % num_shards
+
+
+def manifest_path(base_dir, shard, num_shards):
+    return Path(base_dir, 'manifests', f'shard_{shard}_of_{num_shards}.json')
+
+
+def write_manifest(base_dir, shard, num_shards, names):
+    """Records that all images of a shard were exported. Written only once
+       the export of the shard is complete.
+    """
+    path = manifest_path(base_dir, shard, num_shards)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    manifest = {'shard': shard, 'num_shards': num_shards,
+                'num_images': len(names), 'names': sorted(names)}
+    tmp_path = Path(path.parent, f'.{path.name}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def check_manifests(base_dir, num_shards, exists):
+    """Verifies that all shards of an export are complete.
+
+    Arguments:
+        base_dir: The root directory of the export.
+        num_shards: The number of shards of the export.
+        exists: A function indicating whether the predictions of an image,
+            given its name, were exported.
+
+    Returns:
+        A dictionary with the lists of missing shards, of images assigned to
+        several shards, and of images listed in a manifest but not exported.
+    """
+    names = {}
+    missing_shards = []
+    for shard in range(num_shards):
+        path = manifest_path(base_dir, shard, num_shards)
+        if not path.exists():
+            missing_shards.append(shard)
+            continue
+        with open(path, 'r') as f:
+            for name in json.load(f)['names']:
+                names.setdefault(name, []).append(shard)
+    return {
+        'missing_shards': missing_shards,
+        'duplicates': sorted(n for n, s in names.items() if len(s) > 1),
+        'missing_images': sorted(n for n in names if not exists(n)),
+        'num_images': len(names),
+    }
@@ -0,0 +1,147 @@
+import os
+import queue
+import threading
+import logging
+import numpy as np
+from pathlib import Path
+
+from .export_store import ExportStore, serialize
+
+
+def fsync_path(path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class NpzWriter(object):
+    """Writes `.npz` files from background threads, such that inference and
+       disk I/O overlap. Pending writes are held in a bounded queue, so
+       `write` blocks when the disk cannot keep up.
+
+    Arguments:
+        base_dir: The root directory of the files.
+        container: Whether to append the predictions to a single
+            `ExportStore` in `base_dir` instead of writing individual files.
+        part: The part of the container to append to, if any.
+        num_workers: The number of writer threads, or 0 to write synchronously.
+        max_queue_size: The maximum number of pending writes.
+        fsync: When to flush the files to disk: `'none'` leaves it to the OS,
+            `'file'` syncs each file after writing it, and `'end'` syncs the
+            written files and their directories once all writes are done.
+    """
+    fsync_policies = {'none', 'file', 'end'}
+
+    def __init__(self, base_dir, container=False, part=None, num_workers=2,
+                 max_queue_size=16, fsync='none'):
+        assert fsync in self.fsync_policies, f'Unknown fsync policy {fsync}'
+        self.base_dir = Path(base_dir)
+        self.fsync = fsync
+        self.store = (ExportStore(base_dir, mode='a', part=part)
+                      if container else None)
+        self.created_dirs = set()
+        self.written = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.workers = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(num_workers)]
+        for w in self.workers:
+            w.start()
+
+    def _write(self, name, data):
+        if self.store is not None:
+            # Serialization runs in parallel, only appending is sequential
+            self.store.append(name, serialize(data))
+            if self.fsync == 'file':
+                self.store.sync()
+            return
+        path = Path(self.base_dir, f'{name}.npz')
+        if path.parent not in self.created_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.created_dirs.add(path.parent)
+        # Readers never see partially written files
+        tmp_path = Path(path.parent, f'.{path.name}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **data)
+            if self.fsync == 'file':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.fsync == 'end':
+            self.written.append(path)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                if self.error is None:
+                    self._write(*item)
+            except Exception as e:
+                logging.exception('Could not write %s', item[0])
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def exists(self, name):
+        """Whether the predictions of an image were written by a previous run.
+        """
+        if self.store is not None:
+            return name in self.store
+        return Path(self.base_dir, f'{name}.npz').exists()
+
+    def write(self, name, data):
+        """Schedules the export of `data` to `<base_dir>/<name>.npz`, or to
+           the entry `name` of the container.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.workers:
+            self.queue.put((name, data))
+        else:
+            self._write(name, data)
+
+    def close(self, raise_error=True):
+        """Waits for all pending writes and stops the threads. The first
+           write error is raised, or only logged if `raise_error` is False.
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+        if self.store is not None:
+            if self.fsync == 'end' and self.error is None:
+                self.store.sync()
+            self.store.close()
+            self.store = None
+        if self.error is not None:
+            if raise_error:
+                raise self.error
+            logging.error('Some predictions could not be written: %s',
+                          self.error)
+        elif self.fsync == 'end':
+            self._sync_written()
+
+    def _sync_written(self):
+        # Renamed files and created directories are durable only once their
+        # parent directory is synced
+        dirs = {self.base_dir}
+        for path in self.written:
+            fsync_path(path)
+            dirs.add(path.parent)
+        for d in self.created_dirs:
+            dirs.update(p for p in d.parents if self.base_dir in p.parents)
+        for d in dirs:
+            fsync_path(d)
+        self.written = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not hide an exception raised within the block
+        self.close(raise_error=exc_type is None)
@@ -0,0 +1,275 @@
+#pragma once
+
+#include <algorithm>
+#include <cmath>
+#include <memory>
+#include <numeric>
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+
+#include <glog/logging.h>
+
+#include <nabo/nabo.h>
+
+#include "hloc/nanoflann.hpp"
+
+namespace hloc {
+
+// Nearest neighbor search over the global image descriptors. The descriptor
+// matrix (one column per image) is owned by the caller and must outlive the
+// index. Distances are squared L2.
+class GlobalIndex {
+public:
+  virtual ~GlobalIndex() {}
+
+  virtual void build(const Eigen::MatrixXf& descriptors) = 0;
+
+  // Returns at most k neighbors, sorted by increasing distance.
+  virtual void knn(const Eigen::VectorXf& query, int k,
+                   Eigen::VectorXi* indices, Eigen::VectorXf* dists2) const = 0;
+};
+
+// Selects the k smallest entries of dists2, sorted. candidates maps the
+// entries of dists2 to the returned indices (identity if empty).
+inline void selectTopK(const Eigen::VectorXf& dists2, int k,
+                       const std::vector<int>& candidates,
+                       Eigen::VectorXi* indices, Eigen::VectorXf* out_dists2) {
+  CHECK_NOTNULL(indices);
+  CHECK_NOTNULL(out_dists2);
+  const int num_candidates = dists2.size();
+  k = std::min(k, num_candidates);
+
+  std::vector<int> order(num_candidates);
+  std::iota(order.begin(), order.end(), 0);
+  std::partial_sort(order.begin(), order.begin() + k, order.end(),
+                    [&dists2](const int a, const int b) {
+                      return dists2(a) < dists2(b);
+                    });
+
+  indices->resize(k);
+  out_dists2->resize(k);
+  for (int i = 0; i < k; ++i) {
+    (*indices)(i) = candidates.empty() ? order[i] : candidates[order[i]];
+    (*out_dists2)(i) = dists2(order[i]);
+  }
+}
+
+// Original backend: libnabo KD-tree with a linear heap.
+class KdTreeGlobalIndex : public GlobalIndex {
+public:
+  void build(const Eigen::MatrixXf& descriptors) override {
+    nns_.reset(Nabo::NNSearchF::createKDTreeLinearHeap(descriptors));
+    num_images_ = descriptors.cols();
+  }
+
+  void knn(const Eigen::VectorXf& query, int k,
+           Eigen::VectorXi* indices, Eigen::VectorXf* dists2) const override {
+    CHECK(nns_);
+    k = std::min(k, num_images_);
+    indices->resize(k);
+    dists2->resize(k);
+    nns_->knn(query, *indices, *dists2, k, 0,
+              Nabo::NNSearchF::SORT_RESULTS | Nabo::NNSearchF::ALLOW_SELF_MATCH);
+  }
+
+private:
+  std::unique_ptr<Nabo::NNSearchF> nns_;
+  int num_images_ = 0;
+};
+
+// Exhaustive search as a matrix product, processed in blocks of images so
+// that each block of descriptors stays in cache.
+class BruteForceGlobalIndex : public GlobalIndex {
+public:
+  void build(const Eigen::MatrixXf& descriptors) override {
+    descriptors_ = &descriptors;
+    squared_norms_ = descriptors.colwise().squaredNorm().transpose();
+  }
+
+  void knn(const Eigen::VectorXf& query, int k,
+           Eigen::VectorXi* indices, Eigen::VectorXf* dists2) const override {
+    CHECK_NOTNULL(descriptors_);
+    constexpr int kBlockSize = 4096;
+    const int num_images = descriptors_->cols();
+    Eigen::VectorXf all_dists2(num_images);
+    for (int start = 0; start < num_images; start += kBlockSize) {
+      const int size = std::min(kBlockSize, num_images - start);
+      all_dists2.segment(start, size).noalias() =
+          descriptors_->middleCols(start, size).transpose() * query;
+      all_dists2.segment(start, size) =
+          squared_norms_.segment(start, size) - 2 * all_dists2.segment(start, size);
+    }
+    all_dists2.array() += query.squaredNorm();
+    selectTopK(all_dists2, k, {}, indices, dists2);
+  }
+
+private:
+  const Eigen::MatrixXf* descriptors_ = nullptr;
+  Eigen::VectorXf squared_norms_;
+};
+
+// KD-tree from the vendored nanoflann.
+class NanoflannGlobalIndex : public GlobalIndex {
+public:
+  // Exposes the column-major descriptor matrix to nanoflann.
+  struct DatasetAdaptor {
+    const Eigen::MatrixXf* descriptors = nullptr;
+
+    size_t kdtree_get_point_count() const { return descriptors->cols(); }
+    float kdtree_get_pt(const size_t idx, const size_t dim) const {
+      return (*descriptors)(dim, idx);
+    }
+    template <class BBox>
+    bool kdtree_get_bbox(BBox&) const { return false; }
+  };
+
+  typedef nanoflann::KDTreeSingleIndexAdaptor<
+      nanoflann::L2_Adaptor<float, DatasetAdaptor>, DatasetAdaptor, -1, int>
+      KdTree;
+
+  explicit NanoflannGlobalIndex(int leaf_max_size = 10)
+      : leaf_max_size_(leaf_max_size) {}
+
+  void build(const Eigen::MatrixXf& descriptors) override {
+    dataset_.descriptors = &descriptors;
+    tree_.reset(new KdTree(
+        descriptors.rows(), dataset_,
+        nanoflann::KDTreeSingleIndexAdaptorParams(leaf_max_size_)));
+    tree_->buildIndex();
+  }
+
+  void knn(const Eigen::VectorXf& query, int k,
+           Eigen::VectorXi* indices, Eigen::VectorXf* dists2) const override {
+    CHECK(tree_);
+    indices->resize(k);
+    dists2->resize(k);
+    const size_t num_found = tree_->knnSearch(
+        query.data(), k, indices->data(), dists2->data());
+    indices->conservativeResize(num_found);
+    dists2->conservativeResize(num_found);
+  }
+
+private:
+  int leaf_max_size_;
+  DatasetAdaptor dataset_;
+  std::unique_ptr<KdTree> tree_;
+};
+
+// Inverted file: k-means coarse quantizer, exhaustive search within the
+// lists of the num_probes closest centroids.
+class InvertedFileGlobalIndex : public GlobalIndex {
+public:
+  // num_lists <= 0 selects sqrt(number of images).
+  InvertedFileGlobalIndex(int num_lists, int num_probes,
+                          int num_kmeans_iterations = 10)
+      : num_lists_(num_lists), num_probes_(num_probes),
+        num_kmeans_iterations_(num_kmeans_iterations) {
+    CHECK_GT(num_probes_, 0);
+  }
+
+  void build(const Eigen::MatrixXf& descriptors) override {
+    descriptors_ = &descriptors;
+    const int num_images = descriptors.cols();
+    CHECK_GT(num_images, 0);
+    int num_lists = num_lists_ > 0 ? num_lists_
+        : static_cast<int>(std::sqrt(static_cast<double>(num_images)));
+    num_lists = std::max(1, std::min(num_lists, num_images));
+
+    // Deterministic initialization with evenly strided images.
+    centroids_.resize(descriptors.rows(), num_lists);
+    for (int j = 0; j < num_lists; ++j) {
+      centroids_.col(j) = descriptors.col(
+          static_cast<int64_t>(j) * num_images / num_lists);
+    }
+
+    std::vector<int> assignments(num_images);
+    for (int iter = 0; iter < num_kmeans_iterations_; ++iter) {
+      assign(descriptors, &assignments);
+
+      Eigen::MatrixXf sums = Eigen::MatrixXf::Zero(descriptors.rows(), num_lists);
+      Eigen::VectorXi counts = Eigen::VectorXi::Zero(num_lists);
+      for (int i = 0; i < num_images; ++i) {
+        sums.col(assignments[i]) += descriptors.col(i);
+        ++counts(assignments[i]);
+      }
+      for (int j = 0; j < num_lists; ++j) {
+        // Empty clusters keep their previous centroid.
+        if (counts(j) > 0) {
+          centroids_.col(j) = sums.col(j) / static_cast<float>(counts(j));
+        }
+      }
+    }
+    assign(descriptors, &assignments);
+
+    lists_.assign(num_lists, std::vector<int>());
+    for (int i = 0; i < num_images; ++i) {
+      lists_[assignments[i]].push_back(i);
+    }
+  }
+
+  void knn(const Eigen::VectorXf& query, int k,
+           Eigen::VectorXi* indices, Eigen::VectorXf* dists2) const override {
+    CHECK_NOTNULL(descriptors_);
+    const Eigen::VectorXf centroid_dists2 =
+        centroid_squared_norms_ - 2 * centroids_.transpose() * query;
+    Eigen::VectorXi probes;
+    Eigen::VectorXf unused;
+    selectTopK(centroid_dists2, num_probes_, {}, &probes, &unused);
+
+    std::vector<int> candidates;
+    for (int p = 0; p < probes.size(); ++p) {
+      const std::vector<int>& list = lists_[probes(p)];
+      candidates.insert(candidates.end(), list.begin(), list.end());
+    }
+
+    Eigen::VectorXf candidate_dists2(candidates.size());
+    for (size_t i = 0; i < candidates.size(); ++i) {
+      candidate_dists2(i) = (descriptors_->col(candidates[i]) - query).squaredNorm();
+    }
+    selectTopK(candidate_dists2, k, candidates, indices, dists2);
+  }
+
+private:
+  // Assigns each descriptor to its closest centroid.
+  void assign(const Eigen::MatrixXf& descriptors, std::vector<int>* assignments) {
+    constexpr int kBlockSize = 4096;
+    centroid_squared_norms_ = centroids_.colwise().squaredNorm().transpose();
+    for (int start = 0; start < descriptors.cols(); start += kBlockSize) {
+      const int size = std::min<int>(kBlockSize, descriptors.cols() - start);
+      Eigen::MatrixXf dists2 = -2 * centroids_.transpose()
+          * descriptors.middleCols(start, size);
+      dists2.colwise() += centroid_squared_norms_;
+      for (int i = 0; i < size; ++i) {
+        dists2.col(i).minCoeff(&(*assignments)[start + i]);
+      }
+    }
+  }
+
+  int num_lists_;
+  int num_probes_;
+  int num_kmeans_iterations_;
+  const Eigen::MatrixXf* descriptors_ = nullptr;
+  Eigen::MatrixXf centroids_;
+  Eigen::VectorXf centroid_squared_norms_;
+  std::vector<std::vector<int>> lists_;
+};
+
+inline std::unique_ptr<GlobalIndex> createGlobalIndex(
+    const std::string& type, int num_lists, int num_probes) {
+  if (type == "kdtree") {
+    return std::unique_ptr<GlobalIndex>(new KdTreeGlobalIndex());
+  } else if (type == "brute_force") {
+    return std::unique_ptr<GlobalIndex>(new BruteForceGlobalIndex());
+  } else if (type == "nanoflann") {
+    return std::unique_ptr<GlobalIndex>(new NanoflannGlobalIndex());
+  } else if (type == "inverted_file") {
+    return std::unique_ptr<GlobalIndex>(
+        new InvertedFileGlobalIndex(num_lists, num_probes));
+  }
+  LOG(FATAL) << "Unknown global index type: " << type;
+  return nullptr;
+}
+
+}  // namespace hloc
@@ -0,0 +1,77 @@
+import argparse
+import time
+import numpy as np
+
+import _hloc_cpp
+
+global_descriptor_size = 1024
+local_descriptor_size = 256
+
+
+def synthetic_descriptors(num_images, num_queries, num_places, noise, seed):
+    """Clustered unit descriptors, queries are noisy copies of db images."""
+    rng = np.random.RandomState(seed)
+    places = rng.randn(num_places, global_descriptor_size)
+    db = places[rng.randint(num_places, size=num_images)]
+    db += noise * rng.randn(*db.shape)
+    db /= np.linalg.norm(db, axis=1, keepdims=True)
+
+    queries = db[rng.randint(num_images, size=num_queries)]
+    queries = queries + noise * rng.randn(*queries.shape)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return db.astype(np.float32), queries.astype(np.float32)
+
+
+def build_hloc(db):
+    hloc = _hloc_cpp.HLoc()
+    # One dummy keypoint per image, the local data is irrelevant here.
+    keypoints = np.zeros((2, 1), np.float32)
+    local_desc = np.zeros((local_descriptor_size, 1), np.float32)
+    for desc in db:
+        hloc.addImage(desc[np.newaxis], keypoints, local_desc)
+    return hloc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=20000)
+    parser.add_argument('--num_queries', type=int, default=200)
+    parser.add_argument('--num_places', type=int, default=500)
+    parser.add_argument('--noise', type=float, default=0.05)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--num_lists', type=int, default=0)
+    parser.add_argument('--num_probes', type=int, default=8)
+    parser.add_argument('--backends', type=str,
+                        default='kdtree,brute_force,nanoflann,inverted_file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    db, queries = synthetic_descriptors(
+        args.num_images, args.num_queries, args.num_places, args.noise,
+        args.seed)
+    dist = 2 * (1 - queries @ db.T)
+    gt = np.argsort(dist, axis=1)[:, :args.k]
+
+    print(f'{args.num_images} images, {args.num_queries} queries, '
+          f'recall@{args.k}')
+    print('backend        build [s]  query [ms]  recall')
+    for backend in args.backends.split(','):
+        hloc = build_hloc(db)
+        start = time.time()
+        hloc.buildIndex(backend, args.num_lists, args.num_probes)
+        build_time = time.time() - start
+
+        recalls = []
+        durations = []
+        for query, query_gt in zip(queries, gt):
+            start = time.time()
+            indices, _ = hloc.retrieve(query[np.newaxis], args.k)
+            durations.append(time.time() - start)
+            recalls.append(len(np.intersect1d(indices, query_gt)) / args.k)
+
+        print(f'{backend:<14} {build_time:9.3f}  {1e3*np.mean(durations):10.3f}'
+              f'  {np.mean(recalls):6.3f}')
+
+
+if __name__ == "__main__":
+    main()
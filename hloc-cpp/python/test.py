@@ -44,11 +44,10 @@ def main():
     hloc.buildIndex()
 
     # Check retrieval
-    ret = hloc.localize(globaldescr, keypoints, localdescr)
-    (success, num_components_tested, num_inliers,
-     num_iters, global_ms, covis_ms, local_ms, pnp_ms) = ret
-    print(success, num_components_tested, num_inliers, num_iters)
-    print('Timing: ', global_ms, covis_ms, local_ms, pnp_ms)
+    stats = hloc.localize(globaldescr, keypoints, localdescr)
+    print(stats['success'], stats['num_components_tested'],
+          stats['num_inliers'], stats['num_ransac_iters'])
+    print('Timing [us]: ', stats['timings_us'])
 
 
 if __name__ == "__main__":
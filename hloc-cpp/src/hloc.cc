@@ -1,6 +1,11 @@
+#include <algorithm>
 #include <chrono>
+#include <memory>
+#include <numeric>
+#include <string>
 #include <vector>
 #include <unordered_map>
+#include <unordered_set>
 #include <queue>
 
 #include <Eigen/Core>
@@ -11,6 +16,8 @@
 
 #include <nabo/nabo.h>
 
+#include "hloc/global_index.hpp"
+
 #include <opengv/absolute_pose/CentralAbsoluteAdapter.hpp>
 #include <opengv/absolute_pose/methods.hpp>
 #include <opengv/sac/Ransac.hpp>
@@ -27,27 +34,117 @@ using Aligned = Container<Type, Eigen::aligned_allocator<Type>>;
 constexpr int kLocalDescriptorSize = 256;
 constexpr int kGlobalDescriptorSize = 1024;
 
+// Storage type of the local descriptors of the map, widened to float for
+// matching. int8 descriptors are scaled by kInt8DescriptorScale, which
+// assumes L2-normalized descriptors with entries in [-1, 1].
+enum class DescriptorType { kFloat32, kFloat16, kInt8 };
+constexpr float kInt8DescriptorScale = 127.f;
+
 struct Image {
   // Undistorted keypoints in the normalized image plane.
   Eigen::Matrix<float, 2, Eigen::Dynamic> normalized_keypoints;
-  // 256dim for local descriptors.
+  // 256dim for local descriptors, only the one of the map type is filled.
   Eigen::Matrix<float, kLocalDescriptorSize, Eigen::Dynamic> local_descriptors;
+  Eigen::Matrix<Eigen::half, kLocalDescriptorSize, Eigen::Dynamic> local_descriptors_f16;
+  Eigen::Matrix<int8_t, kLocalDescriptorSize, Eigen::Dynamic> local_descriptors_i8;
 
   // -1 if no correspondence.
   Eigen::VectorXi point_indices;
 };
 
+// Order in which the covisibility components are tested: rank of their best
+// retrieved image, number of images, or covisibility weight, i.e. the sum over
+// the pairs of covisible images of the number of 3D points that they share (a
+// point seen by n images of the component counts up to n * (n - 1) / 2 times).
+enum class ComponentOrdering { kRetrieval, kSize, kCovisibility };
+
 struct Point3d {
   Eigen::Vector3f xyz;
 
   std::vector<int> observing_images;
 };
 
+typedef std::chrono::steady_clock Clock;
+
+inline int64_t microsecondsBetween(const Clock::time_point& start, const Clock::time_point& end) {
+  return std::chrono::duration_cast<std::chrono::microseconds>(end - start).count();
+}
+
+// Counters and per-stage timings of a single query. Counters of the local
+// matching are those of the last tested component, timings are accumulated
+// over all tested components.
+struct LocalizationStats {
+  bool success = false;
+  int num_components_total = 0;
+  int num_components_tested = 0;
+  int last_component_size = -1;
+  int num_db_landmarks = 0;
+  int num_matches = 0;
+  int num_inliers = 0;
+  int num_iters = 0;
+
+  int64_t global_us = 0;
+  int64_t covis_us = 0;
+  // Local matching and PnP of all components.
+  int64_t ransac_us = 0;
+  // Local matching: gathering of the db descriptors, KD-tree build and
+  // search, ratio test.
+  int64_t local_us = 0;
+  int64_t local_prep_us = 0;
+  int64_t local_build_us = 0;
+  int64_t local_search_us = 0;
+  int64_t local_filter_us = 0;
+  int64_t pnp_us = 0;
+
+  py::dict toDict() const {
+    py::dict timings;
+    timings["global"] = global_us;
+    timings["covis"] = covis_us;
+    timings["ransac"] = ransac_us;
+    timings["local"] = local_us;
+    timings["local_prep"] = local_prep_us;
+    timings["local_build"] = local_build_us;
+    timings["local_search"] = local_search_us;
+    timings["local_filter"] = local_filter_us;
+    timings["pnp"] = pnp_us;
+
+    py::dict stats;
+    stats["success"] = success;
+    stats["num_components_total"] = num_components_total;
+    stats["num_components_tested"] = num_components_tested;
+    stats["last_component_size"] = last_component_size;
+    stats["num_db_landmarks"] = num_db_landmarks;
+    stats["num_matches"] = num_matches;
+    stats["num_inliers"] = num_inliers;
+    stats["num_ransac_iters"] = num_iters;
+    stats["timings_us"] = timings;
+    return stats;
+  }
+};
+
 class HLoc {
 public:
-  HLoc() {
+  // descriptor_type is the storage type of the local descriptors, one of
+  // float32, float16 or int8.
+  explicit HLoc(const std::string& descriptor_type) {
+    if (descriptor_type == "float32") {
+      descriptor_type_ = DescriptorType::kFloat32;
+    } else if (descriptor_type == "float16") {
+      descriptor_type_ = DescriptorType::kFloat16;
+    } else if (descriptor_type == "int8") {
+      descriptor_type_ = DescriptorType::kInt8;
+    } else {
+      LOG(FATAL) << "Unknown descriptor type: " << descriptor_type;
+    }
     image_descriptors_.resize(kGlobalDescriptorSize, 0);
     ratio_test_value_ = 0.9;
+    component_ordering_ = ComponentOrdering::kRetrieval;
+    verbose_ = true;
+  }
+
+  // Enables or disables the per-query logging.
+  void setVerbose(bool verbose) {
+    verbose_ = verbose;
   }
 
   // Adds an Image and returns its index.
@@ -64,7 +161,7 @@ public:
 
     Image new_image;
     new_image.normalized_keypoints = normalized_keypoints;
-    new_image.local_descriptors = local_descriptors;
+    storeLocalDescriptors(local_descriptors, &new_image);
     new_image.point_indices =  Eigen::VectorXi::Constant(num_keypoints, -1);
     images_.push_back(new_image);
 
@@ -98,107 +195,203 @@ public:
     return new_point_index;
   }
 
-  py::tuple localize(Eigen::Ref<Eigen::Matrix<float, 1, kGlobalDescriptorSize, Eigen::RowMajor>> global_descriptor,
+  // Adds images in bulk and returns the index of the first one. The keypoints
+  // and local descriptors of all images are concatenated, image i owning the
+  // columns [keypoint_offsets(i), keypoint_offsets(i+1)). Column-major inputs
+  // map to transposed numpy arrays without copy.
+  int addImages(Eigen::Ref<const Eigen::Matrix<float, kGlobalDescriptorSize, Eigen::Dynamic>> global_descriptors,
+                Eigen::Ref<const Eigen::Matrix<float, 2, Eigen::Dynamic>> normalized_keypoints,
+                Eigen::Ref<const Eigen::Matrix<float, kLocalDescriptorSize, Eigen::Dynamic>> local_descriptors,
+                Eigen::Ref<const Eigen::VectorXi> keypoint_offsets) {
+    const int num_new_images = global_descriptors.cols();
+    CHECK_EQ(keypoint_offsets.size(), num_new_images + 1);
+    CHECK_EQ(keypoint_offsets(0), 0);
+    CHECK_EQ(keypoint_offsets(num_new_images), normalized_keypoints.cols());
+    CHECK_EQ(normalized_keypoints.cols(), local_descriptors.cols());
+
+    const int first_image_index = images_.size();
+    CHECK_EQ(image_descriptors_.cols(), first_image_index);
+    image_descriptors_.conservativeResize(Eigen::NoChange,
+                                          first_image_index + num_new_images);
+    image_descriptors_.rightCols(num_new_images) = global_descriptors;
+
+    images_.reserve(first_image_index + num_new_images);
+    for (int i = 0; i < num_new_images; ++i) {
+      const int start = keypoint_offsets(i);
+      const int num_keypoints = keypoint_offsets(i + 1) - start;
+      CHECK_GE(num_keypoints, 0);
+      LOG_IF(WARNING, num_keypoints == 0) << "Adding frame " << first_image_index + i
+                                          << " with no keypoints.";
+
+      Image new_image;
+      new_image.normalized_keypoints = normalized_keypoints.middleCols(start, num_keypoints);
+      storeLocalDescriptors(local_descriptors.middleCols(start, num_keypoints), &new_image);
+      new_image.point_indices = Eigen::VectorXi::Constant(num_keypoints, -1);
+      images_.push_back(new_image);
+    }
+
+    return first_image_index;
+  }
+
+  // Adds 3D points in bulk and returns the index of the first one. The
+  // (image index, keypoint index) observations of all points are concatenated,
+  // point i owning the columns [observation_offsets(i), observation_offsets(i+1)).
+  int add3dPoints(Eigen::Ref<const Eigen::Matrix<float, 3, Eigen::Dynamic>> xyz,
+                  Eigen::Ref<const Eigen::Matrix<int, 2, Eigen::Dynamic>> observing_images_and_kpts,
+                  Eigen::Ref<const Eigen::VectorXi> observation_offsets) {
+    const int num_new_points = xyz.cols();
+    CHECK_EQ(observation_offsets.size(), num_new_points + 1);
+    CHECK_EQ(observation_offsets(0), 0);
+    CHECK_EQ(observation_offsets(num_new_points), observing_images_and_kpts.cols());
+
+    const int first_point_index = points_.size();
+    points_.reserve(first_point_index + num_new_points);
+    for (int i = 0; i < num_new_points; ++i) {
+      const int new_point_index = first_point_index + i;
+      Point3d new_point;
+      new_point.xyz = xyz.col(i);
+      for (int j = observation_offsets(i); j < observation_offsets(i + 1); ++j) {
+        const int observing_image_idx = observing_images_and_kpts(0, j);
+        CHECK_LT(observing_image_idx, images_.size());
+        CHECK_GE(observing_image_idx, 0);
+        new_point.observing_images.push_back(observing_image_idx);
+
+        const int observing_kpt_idx = observing_images_and_kpts(1, j);
+        CHECK_GE(observing_kpt_idx, 0);
+        CHECK_LT(observing_kpt_idx, images_[observing_image_idx].point_indices.size());
+        images_[observing_image_idx].point_indices(observing_kpt_idx) = new_point_index;
+      }
+      points_.push_back(new_point);
+    }
+
+    return first_point_index;
+  }
+
+  py::dict localize(Eigen::Ref<Eigen::Matrix<float, 1, kGlobalDescriptorSize, Eigen::RowMajor>> global_descriptor,
                Eigen::Ref<Eigen::Matrix<float, 2, Eigen::Dynamic, Eigen::RowMajor>> row_normalized_keypoints,
                Eigen::Ref<Eigen::Matrix<float, kLocalDescriptorSize, Eigen::Dynamic, Eigen::RowMajor>> row_local_descriptors) {
     CHECK_EQ(row_normalized_keypoints.cols(), row_local_descriptors.cols());
+    LocalizationStats stats;
 
     // Global retrieval first.
     constexpr int kNumNeighbors = 10;
-    Eigen::VectorXi indices(kNumNeighbors);
-    Eigen::VectorXf dists2(kNumNeighbors);
+    Eigen::VectorXi indices;
+    Eigen::VectorXf dists2;
 
-    auto global_start = std::chrono::high_resolution_clock::now();
+    const Clock::time_point global_start = Clock::now();
     CHECK_EQ(global_descriptor.rows(), 1);
     CHECK_EQ(global_descriptor.cols(), kGlobalDescriptorSize);
-    nns_->knn(global_descriptor, indices, dists2, kNumNeighbors, 0, Nabo::NNSearchF::SORT_RESULTS | Nabo::NNSearchF::ALLOW_SELF_MATCH);
+    CHECK(global_index_) << "buildIndex must be called before localize.";
+    global_index_->knn(global_descriptor.transpose(), kNumNeighbors, &indices, &dists2);
 
-    auto covis_start = std::chrono::high_resolution_clock::now();
+    const Clock::time_point covis_start = Clock::now();
 
     std::vector<std::vector<int>> components = covisibilityClustering(indices);
+    stats.num_components_total = components.size();
 
-    auto ransac_start = std::chrono::high_resolution_clock::now();
+    const Clock::time_point ransac_start = Clock::now();
 
     // Copy data as row-major sucks for our arrays.
     Eigen::Matrix<float, 2, Eigen::Dynamic> normalized_keypoints = row_normalized_keypoints;
     Eigen::Matrix<float, kLocalDescriptorSize, Eigen::Dynamic> local_descriptors = row_local_descriptors;
 
-    int num_components_tested = 0;
-    bool pnp_success = false;
-    int num_inliers = 0;
-    int num_iters = 0;
-
-    int total_local_ms = 0;
-    int total_pnp_ms = 0;
-
-    int num_db_landmarks = 0;
-    int num_matches = 0;
-
-    int last_component_size = -1;
-
     for (std::vector<int>& component : components) {
       // Limit component size to 5.
       if (component.size() > 5) {
         component.resize(5);
       }
 
-      ++num_components_tested;
-      last_component_size = component.size();
+      ++stats.num_components_tested;
+      stats.last_component_size = component.size();
 
-      int time_local;
-      int time_pnp;
-      pnp_success = localizeLocally(component, normalized_keypoints, local_descriptors,
-                          &num_db_landmarks, &num_matches, &num_inliers, &num_iters, &time_local, &time_pnp);
-      total_local_ms += time_local;
-      total_pnp_ms += time_pnp;
+      stats.success = localizeLocally(component, normalized_keypoints, local_descriptors, &stats);
 
       // Break the loop if we succeed.
-      if (pnp_success) {
+      if (stats.success) {
         break;
       }
     }
 
-    auto ransac_end = std::chrono::high_resolution_clock::now();
-    auto dur_ransac_ms = std::chrono::duration_cast<std::chrono::milliseconds>(ransac_end - ransac_start);
-    auto dur_covis_ms = std::chrono::duration_cast<std::chrono::milliseconds>(ransac_start - covis_start);
-    auto dur_global_ms = std::chrono::duration_cast<std::chrono::milliseconds>(covis_start - global_start);
-    LOG(INFO) << dur_global_ms.count() << " " << dur_covis_ms.count() << " "
-              << dur_ransac_ms.count() << " 2d3d,pnp(" << total_local_ms
-              << ", " << total_pnp_ms << ") global/covis/local [ms]";
-
-    return py::make_tuple(pnp_success, components.size(), num_components_tested, last_component_size,
-                          num_db_landmarks,
-                          num_matches, num_inliers,
-                          num_iters, dur_global_ms.count(),
-                          dur_covis_ms.count(), total_local_ms, total_pnp_ms);
+    const Clock::time_point ransac_end = Clock::now();
+    stats.global_us = microsecondsBetween(global_start, covis_start);
+    stats.covis_us = microsecondsBetween(covis_start, ransac_start);
+    stats.ransac_us = microsecondsBetween(ransac_start, ransac_end);
+    LOG_IF(INFO, verbose_) << stats.global_us << " " << stats.covis_us << " "
+                           << stats.ransac_us << " 2d3d,pnp(" << stats.local_us
+                           << ", " << stats.pnp_us << ") global/covis/local [us]";
+
+    return stats.toDict();
   }
 
-  void buildIndex() {
+  // global_index_type is one of kdtree (libnabo), brute_force, nanoflann or
+  // inverted_file. num_lists and num_probes only apply to inverted_file.
+  // component_ordering is one of retrieval, size or covisibility.
+  void buildIndex(const std::string& global_index_type, int num_lists, int num_probes,
+                  const std::string& component_ordering) {
     LOG(INFO) << "Found " << images_.size() << " images and "
-              << points_.size() << " 3D points. Building index.";
+              << points_.size() << " 3D points. Building " << global_index_type
+              << " index.";
     CHECK_EQ(images_.size(), image_descriptors_.cols());
 
     CHECK_EQ(image_descriptors_.rows(), kGlobalDescriptorSize);
     CHECK_GT(image_descriptors_.cols(), 0);
-    nns_ = Nabo::NNSearchF::createKDTreeLinearHeap(image_descriptors_);
+    global_index_ = hloc::createGlobalIndex(global_index_type, num_lists, num_probes);
+    global_index_->build(image_descriptors_);
+
+    if (component_ordering == "retrieval") {
+      component_ordering_ = ComponentOrdering::kRetrieval;
+    } else if (component_ordering == "size") {
+      component_ordering_ = ComponentOrdering::kSize;
+    } else if (component_ordering == "covisibility") {
+      component_ordering_ = ComponentOrdering::kCovisibility;
+    } else {
+      LOG(FATAL) << "Unknown component ordering: " << component_ordering;
+    }
+    buildCovisibilityGraph();
+  }
+
+  // Global retrieval only, returns the indices and squared distances of the
+  // k closest images.
+  py::tuple retrieve(Eigen::Ref<Eigen::Matrix<float, 1, kGlobalDescriptorSize, Eigen::RowMajor>> global_descriptor,
+                     int k) const {
+    CHECK(global_index_) << "buildIndex must be called before retrieve.";
+    Eigen::VectorXi indices;
+    Eigen::VectorXf dists2;
+    global_index_->knn(global_descriptor.transpose(), k, &indices, &dists2);
+    return py::make_tuple(indices, dists2);
   }
 
 private:
-  std::unordered_set<int> getConnectedImages(const int image_idx) const {
-    CHECK_LT(image_idx, images_.size());
-    CHECK_GE(image_idx, 0);
-
-    const Eigen::VectorXi& point_indices = images_[image_idx].point_indices;
-    std::unordered_set<int> connected_images;
-    for (int i = 0; i < point_indices.size(); ++i) {
-      const int connected_point_idx = point_indices(i);
-      CHECK_GT(connected_point_idx, -1);
-      CHECK_LT(connected_point_idx, points_.size());
-      CHECK_GE(connected_point_idx, 0);
-      connected_images.insert(points_[connected_point_idx].observing_images.begin(),
-                              points_[connected_point_idx].observing_images.end());
+  template <typename Derived>
+  void storeLocalDescriptors(const Eigen::MatrixBase<Derived>& local_descriptors, Image* image) const {
+    CHECK_NOTNULL(image);
+    switch (descriptor_type_) {
+      case DescriptorType::kFloat32:
+        image->local_descriptors = local_descriptors;
+        break;
+      case DescriptorType::kFloat16:
+        image->local_descriptors_f16 = local_descriptors.template cast<Eigen::half>();
+        break;
+      case DescriptorType::kInt8:
+        image->local_descriptors_i8 = (local_descriptors.array() * kInt8DescriptorScale)
+            .round().max(-kInt8DescriptorScale).min(kInt8DescriptorScale)
+            .template cast<int8_t>().matrix();
+        break;
+    }
+  }
+
+  void widenLocalDescriptors(const Image& image, Eigen::Ref<Eigen::MatrixXf> local_descriptors) const {
+    switch (descriptor_type_) {
+      case DescriptorType::kFloat32:
+        local_descriptors = image.local_descriptors;
+        break;
+      case DescriptorType::kFloat16:
+        local_descriptors = image.local_descriptors_f16.cast<float>();
+        break;
+      case DescriptorType::kInt8:
+        local_descriptors = image.local_descriptors_i8.cast<float>() / kInt8DescriptorScale;
+        break;
     }
-    return connected_images;
   }
 
   bool doPnpRansac(const opengv::points_t& points, const opengv::bearingVectors_t& bearing_vectors, int* num_inliers, int* num_iters) const {
@@ -230,7 +423,7 @@ private:
     *num_inliers = ransac.inliers_.size();
     *num_iters = ransac.iterations_;
 
-    LOG(INFO) << "Ransac " << ransac_success << ": " << *num_inliers << " inliers, " << *num_iters << " it, " << points.size() << " points.";
+    LOG_IF(INFO, verbose_) << "Ransac " << ransac_success << ": " << *num_inliers << " inliers, " << *num_iters << " it, " << points.size() << " points.";
 
     return ransac_success;
   }
@@ -238,15 +431,16 @@ private:
   bool localizeLocally(const std::vector<int>& frame_component,
                        const Eigen::Matrix<float, 2, Eigen::Dynamic>& normalized_keypoints,
                        const Eigen::Matrix<float, kLocalDescriptorSize, Eigen::Dynamic>& local_descriptors,
-                       int* num_db_landmarks, int* num_matches, int* num_inliers, int* num_iters, int* time_local_ms, int* time_ransac_ms) const {
-    CHECK_NOTNULL(num_db_landmarks);
-    CHECK_NOTNULL(num_matches);
-    CHECK_NOTNULL(time_local_ms);
-    CHECK_NOTNULL(time_ransac_ms);
-
+                       LocalizationStats* stats) const {
+    CHECK_NOTNULL(stats);
     CHECK(!frame_component.empty());
 
-    auto local_prep_start = std::chrono::high_resolution_clock::now();
+    stats->num_db_landmarks = 0;
+    stats->num_matches = 0;
+    stats->num_inliers = 0;
+    stats->num_iters = 0;
+
+    const Clock::time_point local_prep_start = Clock::now();
 
     // First check the total size of the db to preallocate memory.
     int total_num_db_points = 0;
@@ -256,14 +450,9 @@ private:
 
     if (total_num_db_points == 0) {
       // No db points, quit early.
-      *num_db_landmarks = 0;
-      *num_matches = 0;
-      *num_inliers = 0;
-      *num_iters = 0;
-      auto local_bailout = std::chrono::high_resolution_clock::now();
-      *time_local_ms = std::chrono::duration_cast<std::chrono::milliseconds>(local_bailout - local_prep_start).count();
-      *time_ransac_ms = 0;
-
+      const Clock::time_point local_bailout = Clock::now();
+      stats->local_prep_us += microsecondsBetween(local_prep_start, local_bailout);
+      stats->local_us += microsecondsBetween(local_prep_start, local_bailout);
       return false;
     }
 
@@ -279,30 +468,30 @@ private:
       // Copy point indices.
       db_point_indices.segment(index, num_points) = image.point_indices;
       // Copy descriptors.
-      db_local_descriptors.block(0, index, kLocalDescriptorSize, num_points) = image.local_descriptors;
+      widenLocalDescriptors(image, db_local_descriptors.middleCols(index, num_points));
 
       index += num_points;
     }
 
-    *num_db_landmarks = total_num_db_points;
+    stats->num_db_landmarks = total_num_db_points;
 
     constexpr int kLocalNumNeighbors = 2;
     Eigen::MatrixXi indices(kLocalNumNeighbors, local_descriptors.cols());
     Eigen::MatrixXf dists2(kLocalNumNeighbors, local_descriptors.cols());
 
-    auto local_build = std::chrono::high_resolution_clock::now();
+    const Clock::time_point local_build = Clock::now();
 
     CHECK_EQ(db_local_descriptors.rows(), kLocalDescriptorSize);
     CHECK_GT(db_local_descriptors.cols(), 0);
     Nabo::NNSearchF* local_nns = Nabo::NNSearchF::createKDTreeTreeHeap(db_local_descriptors);
 
-    auto local_search = std::chrono::high_resolution_clock::now();
+    const Clock::time_point local_search = Clock::now();
 
     CHECK_EQ(local_descriptors.rows(), kLocalDescriptorSize);
     CHECK_GT(local_descriptors.cols(), 0);
     local_nns->knn(local_descriptors, indices, dists2, kLocalNumNeighbors, 0, Nabo::NNSearchF::SORT_RESULTS | Nabo::NNSearchF::ALLOW_SELF_MATCH);
 
-    auto filtering_start = std::chrono::high_resolution_clock::now();
+    const Clock::time_point filtering_start = Clock::now();
 
     delete local_nns;
 
@@ -330,36 +519,77 @@ private:
     points.resize(idx);
     bearing_vectors.resize(idx);
 
-    *num_matches = idx;
+    stats->num_matches = idx;
 
-    auto pnp_start = std::chrono::high_resolution_clock::now();
+    const Clock::time_point pnp_start = Clock::now();
+    stats->local_prep_us += microsecondsBetween(local_prep_start, local_build);
+    stats->local_build_us += microsecondsBetween(local_build, local_search);
+    stats->local_search_us += microsecondsBetween(local_search, filtering_start);
+    stats->local_filter_us += microsecondsBetween(filtering_start, pnp_start);
+    stats->local_us += microsecondsBetween(local_prep_start, pnp_start);
 
     if (points.size() < 12) {
       // Bail out early.
-      *num_inliers = 0;
-      *num_iters = 0;
-      auto local_bailout = std::chrono::high_resolution_clock::now();
-      *time_local_ms = std::chrono::duration_cast<std::chrono::milliseconds>(pnp_start - local_prep_start).count();
-      *time_ransac_ms = 0;
-
       return false;
     }
 
-    const bool pnp_success = doPnpRansac(points, bearing_vectors, num_inliers, num_iters);
-
-    auto pnp_end = std::chrono::high_resolution_clock::now();
+    const bool pnp_success = doPnpRansac(points, bearing_vectors, &stats->num_inliers, &stats->num_iters);
 
-    LOG(INFO) << "Num db/query " << db_local_descriptors.cols() << " / " << local_descriptors.cols();
+    const Clock::time_point pnp_end = Clock::now();
+    stats->pnp_us += microsecondsBetween(pnp_start, pnp_end);
 
-    *time_local_ms = std::chrono::duration_cast<std::chrono::milliseconds>(pnp_start - local_prep_start).count();
-    *time_ransac_ms = std::chrono::duration_cast<std::chrono::milliseconds>(pnp_end - pnp_start).count();
+    LOG_IF(INFO, verbose_) << "Num db/query " << db_local_descriptors.cols() << " / " << local_descriptors.cols();
 
     return pnp_success;
   }
 
+  // Precomputes the image adjacency in CSR format: the neighbors of image i
+  // are covisibility_neighbors_[covisibility_offsets_[i]:covisibility_offsets_[i+1]],
+  // sorted, with the number of shared 3D points as weights.
+  void buildCovisibilityGraph() {
+    const int num_images = images_.size();
+    covisibility_offsets_.assign(1, 0);
+    covisibility_neighbors_.clear();
+    covisibility_weights_.clear();
+
+    std::vector<int> num_shared_points(num_images, 0);
+    std::vector<int> connected_images;
+    for (int image_idx = 0; image_idx < num_images; ++image_idx) {
+      const Eigen::VectorXi& point_indices = images_[image_idx].point_indices;
+      for (int i = 0; i < point_indices.size(); ++i) {
+        const int point_idx = point_indices(i);
+        if (point_idx < 0) {
+          continue;
+        }
+        CHECK_LT(point_idx, points_.size());
+        for (const int connected_image : points_[point_idx].observing_images) {
+          if (connected_image != image_idx && num_shared_points[connected_image]++ == 0) {
+            connected_images.push_back(connected_image);
+          }
+        }
+      }
+
+      std::sort(connected_images.begin(), connected_images.end());
+      for (const int connected_image : connected_images) {
+        covisibility_neighbors_.push_back(connected_image);
+        covisibility_weights_.push_back(num_shared_points[connected_image]);
+        num_shared_points[connected_image] = 0;
+      }
+      connected_images.clear();
+      covisibility_offsets_.push_back(covisibility_neighbors_.size());
+    }
+    LOG(INFO) << "Covisibility graph has " << covisibility_neighbors_.size() / 2
+              << " edges.";
+  }
+
   std::vector<std::vector<int>> covisibilityClustering(const Eigen::VectorXi& indices) const {
+    CHECK_EQ(covisibility_offsets_.size(), images_.size() + 1);
     std::unordered_set<int> visited;
     std::vector<std::vector<int>> components;
+    // Sum over the covisibility edges of each component of the number of 3D
+    // points shared by the two images. A point observed by n images of the
+    // component is counted up to n * (n - 1) / 2 times, once per pair.
+    std::vector<int> component_weights;
 
     std::unordered_set<int> frame_ids;
     for (int i = 0; i < indices.size(); ++i) {
@@ -373,6 +603,7 @@ private:
 
       // New component.
       components.resize(components.size() + 1);
+      component_weights.push_back(0);
 
       std::queue<int> queue;
       queue.push(indices(i));
@@ -386,22 +617,56 @@ private:
         }
 
         components.back().push_back(exploration_frame);
-        std::unordered_set<int> connected_frames = getConnectedImages(exploration_frame);
-
-        for (const int connected_frame : connected_frames) {
-          if (frame_ids.count(connected_frame) > 0u && visited.count(connected_frame) == 0u) {
+        for (int j = covisibility_offsets_[exploration_frame];
+             j < covisibility_offsets_[exploration_frame + 1]; ++j) {
+          const int connected_frame = covisibility_neighbors_[j];
+          if (frame_ids.count(connected_frame) == 0u) {
+            continue;
+          }
+          // Count each edge of the component once.
+          if (connected_frame > exploration_frame) {
+            component_weights.back() += covisibility_weights_[j];
+          }
+          if (visited.count(connected_frame) == 0u) {
             queue.push(connected_frame);
           }
         }
       }
     }
 
-    return components;
+    if (component_ordering_ == ComponentOrdering::kRetrieval) {
+      return components;
+    }
+
+    // Stable sort to keep the retrieval order between ties.
+    std::vector<int> order(components.size());
+    std::iota(order.begin(), order.end(), 0);
+    if (component_ordering_ == ComponentOrdering::kSize) {
+      std::stable_sort(order.begin(), order.end(), [&components](const int a, const int b) {
+        return components[a].size() > components[b].size();
+      });
+    } else {
+      std::stable_sort(order.begin(), order.end(), [&component_weights](const int a, const int b) {
+        return component_weights[a] > component_weights[b];
+      });
+    }
+    std::vector<std::vector<int>> sorted_components;
+    sorted_components.reserve(components.size());
+    for (const int idx : order) {
+      sorted_components.push_back(std::move(components[idx]));
+    }
+    return sorted_components;
   }
 
   std::vector<Image> images_;
   Aligned<std::vector, Point3d> points_;
-  Nabo::NNSearchF* nns_;
+  std::unique_ptr<hloc::GlobalIndex> global_index_;
+  std::vector<int> covisibility_offsets_;
+  std::vector<int> covisibility_neighbors_;
+  std::vector<int> covisibility_weights_;
+  ComponentOrdering component_ordering_;
+  bool verbose_;
+  DescriptorType descriptor_type_;
   // 1024dim for global descriptor. Eigen is column major by default.
   Eigen::MatrixXf image_descriptors_;
   double ratio_test_value_;
@@ -411,9 +676,16 @@ PYBIND11_MODULE(_hloc_cpp, m) {
     m.doc() = "pybind11 Hierarchical Localization cpp backend";
 
     py::class_<HLoc>(m, "HLoc")
-    .def(py::init())
+    .def(py::init<const std::string&>(), py::arg("descriptor_type") = "float32")
     .def("addImage", &HLoc::addImage, py::return_value_policy::copy)
     .def("add3dPoint", &HLoc::add3dPoint, py::return_value_policy::copy)
-    .def("buildIndex", &HLoc::buildIndex)
+    .def("addImages", &HLoc::addImages, py::return_value_policy::copy)
+    .def("add3dPoints", &HLoc::add3dPoints, py::return_value_policy::copy)
+    .def("buildIndex", &HLoc::buildIndex,
+         py::arg("global_index_type") = "kdtree",
+         py::arg("num_lists") = 0, py::arg("num_probes") = 8,
+         py::arg("component_ordering") = "retrieval")
+    .def("retrieve", &HLoc::retrieve, py::return_value_policy::copy)
+    .def("setVerbose", &HLoc::setVerbose)
     .def("localize", &HLoc::localize, py::return_value_policy::copy);
 }